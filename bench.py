@@ -0,0 +1,506 @@
+#! /usr/bin/env python
+# $Id$
+# NAME
+#	bench - benchmark the shown script
+# SYNTAX
+#	bench [-dhJuv] [-r <repeat>] parsedate [<metadata-paths...>]
+#	bench [-dhJuv] [-M <metadate>] [-r <repeat>] phases [<metadata-paths...>]
+#	bench [-dhuv] [-n <count>] [-S <seed>] generate <directory>
+#	bench [-dhJuv] [-n <count>[,...]] [-S <seed>] suite <directory>
+#	bench [-dhJuv] [-B <milliseconds>] [-r <repeat>] startup
+# DESCRIPTION
+#	Times parts of the shown script against a corpus of '.meta' files.
+#	The parsedate benchmark times parsing every date string found in the
+#	metadata files, with and without reusing previously parsed dates.
+#	The phases benchmark times each phase of a shown run separately:
+#	walk (scanning & stat), parse, initdelta (summing the deltas), estimate
+#	and output.
+#	The generate command writes a synthetic corpus of metadata files
+#	(with backups, fuzzy dates, multi-tag lines and bad tags) and the
+#	suite command generates corpora of each size and times their phases.
+#	The startup benchmark times runs of the meta script (against a
+#	temporary mirror, so without the network) and fails if any takes
+#	longer than the budget.
+# OPTIONS
+#	-B MILLISECONDS, --budget=MILLISECONDS
+#				start up time budget for the startup benchmark
+#				(default: 60).
+#	-d, --debug		Show debugging info.
+#	-h, --help		Display help message.
+#	-J, --json		Output results as JSON, one object per line.
+#	-M YYYY-MM-DD, --metadate=YYYY-MM-DD
+#				metadate for the phases benchmark (default: none).
+#	-n COUNT[,...], --count=COUNT[,...]
+#				number of '.meta' files to generate, several
+#				for the suite (default: 1000,10000,100000).
+#	-r REPEAT, --repeat=REPEAT
+#				number of times to repeat each timing,
+#				the best time is reported (default: 5).
+#	-S SEED, --seed=SEED	random seed for generating (default: 1963).
+#	-u, --usage		Display examples for executing the bench script.
+#	-v, --version		Display version and author.
+# AUTHOR
+#	Peter Lyons
+# IMPLEMENTATION
+#	Imports the shown script as a module, and runs the meta script.
+# GLOBALS
+#	usage_description	initial usage text - basic summary
+#	usage_examples		ending usage text - contains command examples
+#	opts		parsed options information
+#
+
+
+"""Benchmark the broadcast date display utility."""
+__title__ = "Broadcast Date Benchmark Utility"
+__author__ = "darklion"
+__version__ = "0.3.2"
+# Version 0.1	Initial development: date parsing micro benchmark
+# Version 0.2	Synthetic corpus generator & per phase timing with JSON results
+# Version 0.2.1	Time the phases over the column store of parsed metadata
+# Version 0.3	Time the start up of the meta script, within a budget
+# Version 0.3.1	Time summing the deltas (initdelta) apart from estimating again
+# Version 0.3.2	Time the output through the buffered writer, as shown now outputs
+
+usage_description = '''
+This script times parts of the shown script using the supplied metadata files.
+
+'''
+usage_examples = '''
+Command examples:
+> bench parsedate data
+> bench -r 10 parsedate data/Season\ 198*
+> bench -J -M 2016-09-15 phases data
+> bench -n 1000000 generate /tmp/corpus
+> bench -J -n 1000,10000,100000,1000000 suite /tmp/corpora
+> bench -B 100 startup
+'''
+
+# System modules
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from optparse import OptionParser
+
+# Benchmarked modules
+import shown
+
+
+def FindMeta(paths):
+    '''List the '.meta' files (including backups) of the paths.'''
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+        else:
+            for dirpath, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    if '.meta' in name:
+                        filenames.append(os.path.join(dirpath, name))
+    return filenames
+
+
+def DateValues(filenames):
+    '''Extract the date string of every metadata line, as ParseMeta would.'''
+    values = []
+    for filename in filenames:
+        file = open(filename, 'r')
+        for line in file:
+            record = line.rstrip().split(':')
+            if len(record) > 1:
+                pos = 0
+                if record[0].isalpha() or (not record[1].isalpha() and
+                                           record[0].find('|') >= 0):
+                    pos = 1
+                values.append(record[pos])
+        file.close()
+    return values
+
+
+def Best(func, repeat):
+    '''Return the best time of repeated calls of the function.'''
+    best = None
+    for count in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def Report(benchmark, results, asjson=False, **extra):
+    '''Output the (name, seconds) results of a benchmark, as text or JSON.'''
+    if asjson:
+        record = {'benchmark': benchmark, 'version': shown.__version__,
+                  'python': platform.python_version(),
+                  'results': dict(results)}
+        record.update(extra)
+        sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    else:
+        sys.stdout.write("%s: %s\n" % (benchmark, ', '.join(
+            ["%s=%s" % item for item in sorted(extra.items())])))
+        for (name, elapsed) in results:
+            sys.stdout.write("%-12s %10.6f sec\n" % (name, elapsed))
+    sys.stdout.flush()
+
+
+def BenchParseDate(paths, repeat, asjson=False):
+    '''Time parsing each date string, uncached, cold and warm cached.'''
+    values = DateValues(FindMeta(paths))
+    log = []
+    def Convert():
+        for value in values:
+            shown.ConvertDate(value, log)
+    def Cold():
+        shown.dates.clear()
+        for value in values:
+            shown.ParseDate(value, log)
+    def Warm():
+        for value in values:
+            shown.ParseDate(value, log)
+    results = [('uncached', Best(Convert, repeat)),
+               ('cold cache', Best(Cold, repeat)),
+               ('warm cache', Best(Warm, repeat))]
+    if asjson:
+        Report('parsedate', results, True, lines=len(values),
+               distinct=len(set(values)))
+        return
+    sys.stdout.write("%d date strings (%d distinct)\n" %
+                     (len(values), len(set(values))))
+    for (name, elapsed) in results:
+        sys.stdout.write("%-12s %8.3f usec/line %6.1fx\n" %
+                         (name, elapsed * 1e6 / max(1, len(values)),
+                          results[0][1] / max(elapsed, 1e-9)))
+
+
+def Phases(paths, metadate=None, source='broadcast', target='AU'):
+    '''Run each phase of shown over the paths once, returning the
+       (phase, seconds) timings and the number of files.
+    '''
+    null = open(os.devnull, 'w')
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    timings = []
+    start = time.time()
+# Walk the hierarchies & stat the files
+    tops = [path for path in paths if os.path.isdir(path)]
+    scanned = shown.ScanTree(tops, False, bool(metadate))
+    files = {}
+    selections = shown.WalkOrder(tops, scanned, metadate)
+    for path in paths:
+        if not os.path.isdir(path):
+            files[path] = None
+        else:
+            for (filename, signature) in selections.pop(0):
+                files[filename] = None
+    timings.append(('walk', time.time() - start))
+# Parse the metadata files (quietly)
+    start = time.time()
+    table = shown.MetaTable()
+    (sys.stdout, sys.stderr) = (null, null)
+    try:
+        for (filename, info) in shown.ParseFiles(list(files), {}):
+            files[filename] = table.Add(filename, info)
+    finally:
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+    timings.append(('parse', time.time() - start))
+# Sum the deltas up the tree
+    start = time.time()
+    (tree, targets, pending) = shown.SumTable(table, files, source, target)
+    timings.append(('initdelta', time.time() - start))
+# Estimate the missing dates
+    start = time.time()
+    deltas = shown.EstimatePending(tree, targets, pending)
+    timings.append(('estimate', time.time() - start))
+# Output (to nowhere) through the buffered writer
+    start = time.time()
+    writer = shown.Writer([(source, target)], out=null)
+    for (filename, fileid) in files.iteritems():
+        writer.Write(filename, [shown.TableInfo(fileid, targets, deltas)])
+    writer.Flush()
+    timings.append(('output', time.time() - start))
+    null.close()
+    return (timings, len(files))
+
+
+def BenchPhases(paths, repeat, metadate=None, asjson=False):
+    '''Time each phase of shown, keeping the best time of each phase.'''
+    best = {}
+    for count in range(repeat):
+        shown.dates.clear()
+        (timings, files) = Phases(paths, metadate)
+        for (phase, elapsed) in timings:
+            best[phase] = min(best.get(phase, elapsed), elapsed)
+    results = [(phase, best[phase]) for (phase, elapsed) in timings]
+    results.append(('total', sum([elapsed for (phase, elapsed) in results])))
+    Report('phases', results, asjson, paths=paths, files=files,
+           metadate=metadate and metadate.date().isoformat())
+
+
+def FillMirror(filename, seriesname, seasons=3, episodes=13):
+    '''Write a made up series (as tvdbstub serves) straight into a new
+       meta mirror, fetched now so it is fresh.
+    '''
+    import meta
+    mirror = meta.Mirror(filename, 3600, 1024 * 1024)
+    sid = 70000
+    series = [('id', str(sid)), ('seriesname', seriesname),
+              ('firstaired', '1963-11-23'), ('lastupdated', '1434679247')]
+    now = time.time()
+    with mirror.db:
+        mirror.db.execute("INSERT INTO series VALUES (?, ?, ?, ?, ?, ?)",
+                          (sid, '1434679247', now, now, 0, json.dumps(series)))
+        mirror.db.execute("INSERT INTO names VALUES (?, ?)",
+                          (seriesname.lower(), sid))
+        for season in range(1, seasons + 1):
+            for episode in range(1, episodes + 1):
+                aired = date(1963, 11, 23) + timedelta(365 * (season - 1) + 7 * (episode - 1))
+                record = [('seasonnumber', str(season)), ('episodenumber', str(episode)),
+                          ('episodename', 'Episode %d' % episode),
+                          ('firstaired', aired.isoformat())]
+                mirror.db.execute("INSERT INTO episodes VALUES (?, ?, ?, ?)",
+                                  (sid, season, episode, json.dumps(record)))
+    mirror.Close()
+
+
+def BenchStartup(repeat, budget, asjson=False):
+    '''Time runs of the meta script that need no network (the bare
+       interpreter for comparison), returning the names of those over
+       the budget (in seconds).
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meta.py')
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        filename = os.path.join(tmpdir, 'mirror.db')
+        FillMirror(filename, 'Doctor Who')
+        runs = [('interpreter', ['-c', 'pass']),
+                ('version', [script, '-v']),
+                ('offline', [script, '-o', '-m', filename, 'Doctor Who', '1', '1']),
+                ('fresh', [script, '-m', filename, 'Doctor Who', '2', '3'])]
+        null = open(os.devnull, 'w')
+        results = []
+        for (name, args) in runs:
+            def Run():
+                if subprocess.call([sys.executable] + args, stdout=null) != 0:
+                    raise RuntimeError("%s run of meta failed" % name)
+            results.append((name, Best(Run, repeat)))
+        null.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    Report('startup', results, asjson, budget=budget)
+    return [name for (name, elapsed) in results[1:] if elapsed > budget]
+
+
+# Synthetic corpus ingredients
+TITLES = ['Spearhead', 'Silurians', 'Ambassadors', 'Inferno', 'Autons', 'Mind',
+          'Axos', 'Colony', 'Daemons', 'Daleks', 'Curse', 'Sea', 'Mutants',
+          'Time', 'Carnival', 'Planet', 'Green', 'Warrior', 'Dinosaurs',
+          'Spiders', 'Robot', 'Ark', 'Sontaran', 'Genesis', 'Revenge']
+NETWORKS = ['ABC', 'ABC Adelaide', 'SBS', 'Nine']
+
+
+def FuzzyDate(rnd, day):
+    '''Write a date the way the metadata does, sometimes only partly known.'''
+    choice = rnd.random()
+    if choice < 0.45:
+        return day.isoformat()
+    elif choice < 0.55:
+        return '%s@%02d%02d' % (day.isoformat(), rnd.randint(17, 20),
+                                rnd.choice([0, 15, 30, 45]))
+    elif choice < 0.75:
+        return day.strftime('%Y-%m')
+    elif choice < 0.85:
+        return day.strftime('%Y-%m-') + str(day.day // 10) + '?'
+    elif choice < 0.92:
+        return day.strftime('%Y-') + str(day.month // 10) + '?'
+    return day.strftime('%Y')
+
+
+def EpisodeLines(rnd, broadcast, revision):
+    '''Write the lines of one revision of an episode's metadata.'''
+    lines = []
+    if rnd.random() < 0.01:
+        lines.append('UNAIRED:broadcast')
+    else:
+        lines.append(broadcast.isoformat() + ':broadcast')
+    if revision >= 1 and rnd.random() < 0.7:
+        au = broadcast + timedelta(days=rnd.randint(60, 900))
+        line = FuzzyDate(rnd, au) + ':AU'
+        if rnd.random() < 0.3:
+            line += ':' + au.strftime('%Y-%m')
+        lines.append(line)
+    if revision >= 2 and rnd.random() < 0.5:
+        au = broadcast + timedelta(days=rnd.randint(300, 4000))
+        choice = rnd.random()
+        if choice < 0.1:
+            lines.append('AU|au:' + au.isoformat())
+        elif choice < 0.2:
+            lines.append(au.isoformat() + ':au|ABC')
+        elif choice < 0.6:
+            lines.append('%s@%02d30:au::%s' % (au.isoformat(), rnd.randint(17, 20),
+                                               rnd.choice(NETWORKS)))
+        else:
+            lines.append(FuzzyDate(rnd, au) + ':au')
+    if rnd.random() < 0.005:
+        lines.append(broadcast.strftime('%Y-%m') + ':AU-Adelaide:' + broadcast.strftime('%Y-%m'))
+    if rnd.random() < 0.005:
+        lines.append(broadcast.strftime('%Y') + '-0:AU')
+    return lines
+
+
+def WriteMeta(filename, lines, mtime):
+    '''Write a metadata file with the given modify time.'''
+    file = open(filename, 'w')
+    file.write('\n'.join(lines) + '\n')
+    file.close()
+    os.utime(filename, (mtime, mtime))
+
+
+def Generate(root, count, seed=1963):
+    '''Write a synthetic corpus of count '.meta' files (plus backups) under
+       root, as shows of seasons of multi-part stories.
+    '''
+    rnd = random.Random(seed)
+    epoch = time.mktime(datetime(2014, 6, 1).timetuple())
+    written = 0
+    show = 0
+    while written < count:
+        showname = 'Show.%d' % show
+        for season in range(1, 27):
+            year = 1963 + season
+            dirpath = os.path.join(root, showname, 'Season %d.%d' % (year, season))
+            os.makedirs(dirpath)
+            broadcast = date(year, 1, 1) + timedelta(days=rnd.randint(0, 60))
+            for story in range(1, rnd.randint(4, 8)):
+                title = rnd.choice(TITLES)
+                for part in range(1, rnd.randint(2, 7)):
+                    name = '.%s.%dx%02d.%s.Part.%d.avi.meta' % (showname, season,
+                                                                story, title, part)
+                    filename = os.path.join(dirpath, name)
+                    backups = rnd.choice([0, 1, 1, 2, 2, 3])
+                    revisionseed = rnd.random()
+                    for revision in range(backups + 1):
+                        lines = EpisodeLines(random.Random(revisionseed), broadcast, revision)
+                        mtime = epoch + revision * 200 * 86400 + rnd.randint(0, 150 * 86400)
+                        if revision == backups:
+                            WriteMeta(filename, lines, mtime)
+                        else:
+                            WriteMeta(filename + '.' + str(revision), lines, mtime)
+                    broadcast += timedelta(days=7)
+                    written += 1
+                    if written >= count:
+                        return written
+        show += 1
+    return written
+
+
+def BenchSuite(root, counts, repeat, seed=1963, asjson=False):
+    '''Generate a corpus of each size (unless already there) and time
+       each phase of shown over it.
+    '''
+    for count in counts:
+        corpus = os.path.join(root, str(count))
+        if not os.path.isdir(corpus):
+            Generate(corpus, count, seed)
+        BenchPhases([corpus], repeat, None, asjson)
+
+
+# Main program
+def main():
+# Init globals
+    global opts
+
+# Process arguments
+    parser = OptionParser(usage=u"%prog -dhJuv [-B <milliseconds>] [-M <metadate>] [-n <count>] [-r <repeat>] [-S <seed>] parsedate|phases|generate|suite|startup [<paths>]")
+    parser.add_option( "-B", "--budget", metavar="MILLISECONDS", type="float", default=60,
+                       dest="budget",
+                       help=u"Start up time budget for the startup benchmark")
+    parser.add_option( "-d", "--debug", action="store_true", default=False,
+                       dest="debug",
+                       help=u"Show debugging info")
+    parser.add_option( "-J", "--json", action="store_true", default=False,
+                       dest="json",
+                       help=u"Output results as JSON")
+    parser.add_option( "-M", "--metadate", metavar="METADATE", default=None,
+                       dest="metadate",
+                       help=u"Maximum modify date for the phases benchmark")
+    parser.add_option( "-n", "--count", metavar="COUNT", default='1000,10000,100000',
+                       dest="count",
+                       help=u"Number(s) of metadata files to generate")
+    parser.add_option( "-r", "--repeat", metavar="REPEAT", type="int", default=5,
+                       dest="repeat",
+                       help=u"Number of times to repeat each timing")
+    parser.add_option( "-S", "--seed", metavar="SEED", type="int", default=1963,
+                       dest="seed",
+                       help=u"Random seed for generating metadata files")
+    parser.add_option( "-u", "--usage", action="store_true", default=False,
+                       dest="usage",
+                       help=u"Display examples for executing the bench script")
+    parser.add_option( "-v", "--version", action="store_true", default=False,
+                       dest="version",
+                       help=u"Display version and author")
+    (opts, args) = parser.parse_args()
+
+# Output debugging info?
+    if opts.debug == True:
+        print "opts", opts
+        print "\nargs", args
+
+# Output version info & terminate?
+    if opts.version == True:
+        sys.stdout.write("%s - %s (%s) by %s\n" %
+                         (__file__, __title__, __version__, __author__ ))
+        sys.exit(0)
+
+# Output usage info & terminate?
+    if opts.usage == True:
+        sys.stdout.write(usage_description)
+        parser.print_usage()
+        sys.stdout.write(usage_examples)
+        sys.exit(0)
+
+# Check for required arguments
+    if len(args) == 0:
+        parser.error("Must supply a benchmark name!")
+        sys.exit(1)
+    benchmark = args[0]
+    paths = args[1:] or ['data']
+    counts = [int(count) for count in opts.count.split(',')]
+    if opts.metadate:
+        opts.metadate = datetime.combine(shown.ParseDate(opts.metadate),
+                                         datetime.min.time())
+
+# Run the benchmark
+    if benchmark == 'parsedate':
+        BenchParseDate(paths, opts.repeat, opts.json)
+    elif benchmark == 'phases':
+        BenchPhases(paths, opts.repeat, opts.metadate, opts.json)
+    elif benchmark == 'generate':
+        if len(args) != 2:
+            parser.error("Must supply a directory to generate into!")
+        Generate(args[1], counts[0], opts.seed)
+    elif benchmark == 'suite':
+        if len(args) != 2:
+            parser.error("Must supply a directory for the corpora!")
+        BenchSuite(args[1], counts, opts.repeat, opts.seed, opts.json)
+    elif benchmark == 'startup':
+        over = BenchStartup(opts.repeat, opts.budget / 1000.0, opts.json)
+        if over:
+            sys.stderr.write("Over the %g msec start up budget: %s\n" %
+                             (opts.budget, ', '.join(over)))
+            sys.exit(1)
+    else:
+        parser.error("Unknown benchmark: " + benchmark)
+
+# Finished
+    sys.exit(0)
+#end main
+
+if __name__ == "__main__":
+    main()
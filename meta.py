@@ -3,21 +3,58 @@
 # NAME
 #	meta - display metadata for a tv show
 # SYNTAX
-#	meta [-dhiuv] <showname> [<seasonnumber> <episodenumber>]
+#	meta [-dhiouv] [-m <mirror>] <showname> [<seasonnumber> <episodenumber>]
+#	meta [-dhouv] [-j <jobs>] [-m <mirror>] -b <queryfile>
+#	meta [-dhuv] [-j <jobs>] [-m <mirror>] -R
+#	meta [-dhouv] [-j <jobs>] [-m <mirror>] -g <media-paths...>
 # DESCRIPTION
 #	Prints details for a tv show or an episode from the TVDB site.
+#	In batch mode, each line of the query file (or stdin for '-') is
+#	a show name, optionally followed by season & episode numbers, and
+#	the details of each are printed in the order of the queries.
+#	Shows are kept in a local mirror and read from there until their
+#	time to live is up, then fetched again only if TVDB has updated them.
+#	With -g, the broadcast dates in the '.meta' files of whole trees of
+#	media files are filled in or updated, keeping any previous version
+#	as the next backup version ('.meta.N').
 # OPTIONS
+#	-b QUERYFILE, --batch=QUERYFILE
+#				file of queries, one per line: "<showname>" or
+#				"<showname> <seasonnumber> <episodenumber>"
+#				(or tab separated), '-' for stdin.
 #	-d, --debug		Show debugging info.
+#	-g, --generate		Fill in or update the broadcast dates of the
+#				'.meta' files for the media files in the paths,
+#				named like "Doctor.Who.12x01.Robot.Part.2.avi".
 #	-h, --help		Display help message.
 #	-i, --interactive	Activate tvdb_api interactive mode.
+#	-j JOBS, --jobs=JOBS	number of batch queries looked up at a time,
+#				sharing one connection (default: 4).
+#	-m MIRROR, --mirror=MIRROR
+#				database file for the local mirror of TVDB shows,
+#				'' for none (default: ~/.meta.db).
+#	-o, --offline		Only use the mirror, never the TVDB site.
+#	-R, --refresh		Check all mirrored shows for updates, fetching
+#				only those that TVDB has updated.
+#	-S MEGABYTES, --size=MEGABYTES
+#				size limit of the mirror, dropping the least
+#				recently used shows beyond it (default: 64).
+#	-t HOURS, --ttl=HOURS	time to use mirrored shows before checking for
+#				updates (default: 24).
+#	-U URL, --url=URL	base URL of the TVDB site, eg: a local stand-in
+#				like tvdbstub (default: http://thetvdb.com).
 #	-u, --usage		Display examples for executing the meta script.
 #	-v, --version		Display version and author.
 # AUTHOR
 #	Peter Lyons
 # IMPLEMENTATION
-#	Use the tvdb_api module.
+#	Use the tvdb_api module, imported (with its exceptions, and the client
+#	made) only when a query cannot be answered from the mirror.
 # GLOBALS
-#	tvdb		database connection object
+#	lookup		lookups with one database connection, made when first
+#			needed (shared by batch queries)
+#	mirror		local mirror of shows, consulted first
+#	failures	exceptions raised by failed lookups
 #	usage_description	initial usage text - basic summary
 #	usage_examples		ending usage text - contains command examples
 #	opts		parsed options information
@@ -31,11 +68,17 @@
 """TV metadata utility."""
 __title__ = "TVDB.com Query Utility"
 __author__ = "darklion"
-__version__ = "0.1.3"
+__version__ = "0.2.5"
 # Version 0.1	Initial development
 # Version 0.1.1	Cleanup for further development
 # Version 0.1.2	Define some basic options & usage info
 # Version 0.1.3	Output episode info if season & episode numbers also given
+# Version 0.2.0	Batch mode looking up queries concurrently with one client
+# Version 0.2.1	Local mirror of shows with time to live, size limit & offline use
+# Version 0.2.2	Generate or update the broadcast dates of '.meta' files in bulk
+# Version 0.2.3	Import tvdb_api & make the client only when not answered from the mirror
+# Version 0.2.4	Report a single query not found (eg not in the mirror offline) without a traceback
+# Version 0.2.5	Import the tvdb_api exceptions only with the client too
 
 usage_description = '''
 This script fetches TV series information from TheTVDB.com web site.
@@ -43,6 +86,16 @@ This script fetches TV series information from TheTVDB.com web site.
 '''
 usage_examples = '''
 Command example:
+# Fill in the broadcast dates of a tree of episodes:
+> meta -g "/media/Doctor Who"
+
+# Print an episode from the mirror only, then update the mirror:
+> meta -o "Doctor Who" 23 1
+> meta -R
+
+# Print several shows & episodes, in the order given:
+> printf 'Doctor Who 23 1\nDoctor Who 23 2\nBlakes 7\n' | meta -j 8 -b -
+
 # Print all the show information for a series:
 > meta -i "Doctor Who"
 TVDB Search Results:
@@ -113,22 +166,625 @@ Doctor Who The Mysterious Planet (1):
 	firstaired:  1986-09-06
 '''
 
-# System modules
+# System modules (the thread pool & SQLite modules are imported when needed)
+import json
+import os
+import re
 import sys
+import threading
+import time
 from optparse import OptionParser
 
-# Database modules
-from tvdb_api import Tvdb
+# Database modules: tvdb_api (& its exceptions) are only imported when the
+# client is first needed, as they take most of the start up time
+
+
+class NotMirrored(Exception):
+    ''' A series, season or episode not found in the mirror.'''
+
+
+# What a failed lookup raises: NotMirrored, and the tvdb_api exceptions
+# once it is imported (see Connect)
+failures = (NotMirrored,)
+
+
+def Connect(interactive=False, cache=False, url=None):
+    '''Import tvdb_api & return a new client, pointed at another site if
+       there is a URL.  The tvdb_api exceptions are lookup failures from now.
+    '''
+    global failures
+    from tvdb_api import Tvdb
+    try:
+        from tvdb_exceptions import tvdb_exception
+    except ImportError:
+    # tvdb_api 2.0 on keeps its exceptions in the one module
+        from tvdb_api import tvdb_exception
+    failures = (NotMirrored, tvdb_exception)
+    tvdb = Tvdb(interactive=interactive, cache=cache)
+    if url:
+        SetBaseUrl(tvdb, url)
+    return tvdb
+
+
+def SetBaseUrl(tvdb, url):
+    '''Point the client's URLs at another site, eg: a local stand-in.'''
+    base = tvdb.config['base_url']
+    for key in tvdb.config:
+        if key.startswith('url_'):
+            tvdb.config[key] = tvdb.config[key].replace(base, url.rstrip('/'), 1)
+    tvdb.config['base_url'] = url.rstrip('/')
+
+
+def Output(text):
+    '''Write text to stdout, encoding it for the terminal (or as UTF-8).'''
+    if isinstance(text, unicode):
+        text = text.encode(sys.stdout.encoding or 'utf-8', 'replace')
+    sys.stdout.write(text)
+
+
+def ShowRecord(show):
+    '''Return the show information as a list of (key, value)s.'''
+    return [(key, show[key]) for key in show.data.keys()]
+
+
+def EpisodeRecord(episode):
+    '''Return the episode information as a list of (key, value)s.'''
+    return [(key, episode[key]) for key in episode.keys()]
+
+
+def ShowText(series):
+    '''Return the printout of the show information record.'''
+    text = dict(series)['seriesname'] + ":\n"
+    for (key, value) in series:
+        if key != 'seriesname':
+            text += "\t%s:  %s\n" % (key, value)
+    return text
+
+
+def EpisodeText(series, episode):
+    '''Return the printout of the episode information record.'''
+    text = dict(series)['seriesname'] + " " + dict(episode)['episodename'] + ":\n"
+    for (key, value) in episode:
+        if key != 'episodename':
+            text += "\t%s:  %s\n" % (key, value)
+    return text
+
+
+def ParseQuery(line):
+    '''Split a batch query line into the series name, season number &
+       episode number (None for just a series), or None if it is blank.
+       Fields can be tab separated, otherwise the last two words are the
+       season & episode numbers if both are numeric.
+    '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if '\t' in line:
+        fields = [field.strip() for field in line.split('\t')]
+    else:
+        fields = line.rsplit(None, 2)
+        if len(fields) < 3 or not (fields[1].isdigit() and fields[2].isdigit()):
+            fields = [line]
+    if len(fields) == 1:
+        return (fields[0], None, None)
+    if len(fields) != 3 or not (fields[1].isdigit() and fields[2].isdigit()):
+        raise ValueError("Season & episode numbers must be numeric")
+    return (fields[0], int(fields[1]), int(fields[2]))
+
+
+class Mirror(object):
+    ''' Local store of the series & episode information fetched from TVDB,
+        in an SQLite database.  Each series notes its TVDB lastupdated
+        value, when it was fetched (or last found unchanged) and when it
+        was last used, so that stale series can be checked for changes
+        and the least recently used dropped when over the size limit.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS series (sid INTEGER PRIMARY KEY,
+            lastupdated TEXT, fetched REAL, used REAL, size INTEGER, data TEXT);
+        CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, sid INTEGER);
+        CREATE TABLE IF NOT EXISTS episodes (sid INTEGER, season INTEGER,
+            episode INTEGER, data TEXT, PRIMARY KEY (sid, season, episode));
+    '''
+
+    def __init__(self, filename, ttl, size):
+        import sqlite3
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.used = {}
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def Sid(self, seriesname):
+        '''Return the series id for the series name, or None if unknown.'''
+        with self.lock:
+            row = self.db.execute("SELECT sid FROM names WHERE name = ?",
+                                  (seriesname.lower(),)).fetchone()
+        return row and row[0]
+
+    def Series(self, sid):
+        '''Return the (series information, lastupdated, fetched time) of the
+           series, or None if it is not in the mirror.
+        '''
+        with self.lock:
+            row = self.db.execute("SELECT data, lastupdated, fetched FROM series"
+                                  " WHERE sid = ?", (sid,)).fetchone()
+            if row is None:
+                return None
+            self.used[sid] = time.time()
+        return (json.loads(row[0]), row[1], row[2])
+
+    def Stale(self, fetched):
+        '''Is a series fetched at this time due to be checked for changes?'''
+        return time.time() - fetched > self.ttl
+
+    def Episode(self, sid, seasonnum, episodenum):
+        '''Return the episode information, raising NotMirrored if the
+           season or episode is not in the mirror.
+        '''
+        with self.lock:
+            row = self.db.execute("SELECT data FROM episodes WHERE sid = ?"
+                                  " AND season = ? AND episode = ?",
+                                  (sid, seasonnum, episodenum)).fetchone()
+            if row is None:
+                season = self.db.execute("SELECT 1 FROM episodes WHERE sid = ?"
+                                         " AND season = ?", (sid, seasonnum)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        if season is None:
+            raise NotMirrored("Could not find season %s" % seasonnum)
+        raise NotMirrored("Could not find episode %s" % episodenum)
+
+    def Season(self, sid, seasonnum):
+        '''Return the information of each episode of the season in turn,
+           raising NotMirrored if it is not in the mirror.
+        '''
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM episodes WHERE sid = ?"
+                                   " AND season = ? ORDER BY episode",
+                                   (sid, seasonnum)).fetchall()
+        if not rows:
+            raise NotMirrored("Could not find season %s" % seasonnum)
+        return [json.loads(row[0]) for row in rows]
+
+    def Store(self, sid, show, seriesname=None):
+        '''Replace the series & its episodes with those of the show fetched,
+           under its series name too if given, then drop the least recently
+           used series while over the size limit.
+        '''
+        series = ShowRecord(show)
+        data = json.dumps(series)
+        episodes = [(sid, seasonnum, episodenum,
+                     json.dumps(EpisodeRecord(show[seasonnum][episodenum])))
+                    for seasonnum in show for episodenum in show[seasonnum]]
+        size = len(data) + sum([len(episode[3]) for episode in episodes])
+        now = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM episodes WHERE sid = ?", (sid,))
+                self.db.execute("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?)",
+                                (sid, dict(series).get('lastupdated', None),
+                                 now, now, size, data))
+                self.db.executemany("INSERT INTO episodes VALUES (?, ?, ?, ?)",
+                                    episodes)
+                if seriesname is not None:
+                    self.db.execute("INSERT OR REPLACE INTO names VALUES (?, ?)",
+                                    (seriesname.lower(), sid))
+            self.used[sid] = now
+            self.Evict(sid)
+
+    def Touch(self, sid):
+        '''Note that the series was found unchanged.'''
+        with self.lock:
+            with self.db:
+                self.db.execute("UPDATE series SET fetched = ? WHERE sid = ?",
+                                (time.time(), sid))
+
+    def Evict(self, keep):
+        '''Drop the least recently used series (other than keep) until the
+           mirror is within its size limit.
+        '''
+        self.Flush()
+        total = self.db.execute("SELECT SUM(size) FROM series").fetchone()[0] or 0
+        if total <= self.size:
+            return
+        with self.db:
+            for (sid, size) in self.db.execute("SELECT sid, size FROM series"
+                                               " ORDER BY used").fetchall():
+                if total <= self.size:
+                    break
+                if sid == keep:
+                    continue
+                for table in ('series', 'names', 'episodes'):
+                    self.db.execute("DELETE FROM %s WHERE sid = ?" % table, (sid,))
+                total -= size
+
+    def Flush(self):
+        '''Write the pending last used times.'''
+        if self.used:
+            with self.db:
+                self.db.executemany("UPDATE series SET used = ? WHERE sid = ?",
+                                    [(used, sid) for (sid, used) in self.used.items()])
+            self.used = {}
+
+    def Sids(self):
+        '''Return the ids of all the series in the mirror.'''
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT sid FROM series")]
+
+    def Close(self):
+        '''Write the pending last used times & close the database.'''
+        with self.lock:
+            self.Flush()
+            self.db.close()
+
+
+class Lookup(object):
+    ''' Looks up queries with one shared client, from a pool of threads,
+        fetching each series only once however many queries (and threads)
+        want it.  With a mirror, series are read from it while fresh (or
+        whenever offline), and stale series are only fetched again if their
+        lastupdated value has changed.
+        The client is only made (by calling connect) when first needed, so
+        queries answered from the mirror never make one.
+    '''
+    def __init__(self, connect, mirror=None, offline=False):
+        self.connect = connect
+        self.client = None
+        self.mirror = mirror
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def Tvdb(self):
+        '''Return the client, making it if need be.'''
+        with self.lock:
+            if self.client is None:
+                self.client = self.connect()
+            return self.client
+
+    def Lock(self, key):
+        '''Return the lock for fetching a series.'''
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def Show(self, seriesname):
+        '''Return the show fetched from TVDB.'''
+        tvdb = self.Tvdb()
+        try:
+            return tvdb[seriesname]
+        except KeyError:
+        # Dropped from the client's shows since - fetch it again by id
+            return tvdb[tvdb.corrections[seriesname.lower()]]
+
+    def Lastupdated(self, sid):
+        '''Return the TVDB lastupdated value of the series, fetching only
+           its series information.
+        '''
+        tvdb = self.Tvdb()
+        url = tvdb.config['url_seriesInfo'] % (sid, tvdb.config['language'])
+        return tvdb._getetsrc(url).findtext('Series/lastupdated')
+
+    def Refresh(self, sid):
+        '''Fetch the series again if its lastupdated value has changed,
+           returning whether it was fetched.
+        '''
+        with self.Lock(sid):
+            entry = self.mirror.Series(sid)
+            if entry is not None and self.Lastupdated(sid) == entry[1]:
+                self.mirror.Touch(sid)
+                return False
+            tvdb = self.Tvdb()
+            tvdb.shows.pop(sid, None)
+            self.mirror.Store(sid, tvdb[sid])
+            return True
+
+    def Mirrored(self, seriesname):
+        '''Return the id & information of the series, bringing it into the
+           mirror (or up to date there) if need be.
+        '''
+        sid = self.mirror.Sid(seriesname)
+        if sid is not None:
+            entry = self.mirror.Series(sid)
+            if entry is not None and (self.offline or not self.mirror.Stale(entry[2])):
+                return (sid, entry[0])
+        if self.offline:
+            raise NotMirrored("Show not in the mirror (offline)")
+    # Check again once any other thread fetching the series is done
+        with self.Lock(seriesname.lower()):
+            sid = self.mirror.Sid(seriesname)
+            entry = sid and self.mirror.Series(sid)
+            if not entry:
+                show = self.Show(seriesname)
+                sid = int(show['id'])
+                self.mirror.Store(sid, show, seriesname)
+            elif self.mirror.Stale(entry[2]):
+                self.Refresh(sid)
+            else:
+                return (sid, entry[0])
+        return (sid, self.mirror.Series(sid)[0])
+
+    def Lookup(self, seriesname, seasonnum=None, episodenum=None):
+        '''Return the printout of a series, or of an episode if given.'''
+        if self.mirror is None:
+            with self.Lock(seriesname.lower()):
+                show = self.Show(seriesname)
+            if seasonnum is None:
+                return ShowText(ShowRecord(show))
+            return EpisodeText(ShowRecord(show),
+                               EpisodeRecord(show[seasonnum][episodenum]))
+        (sid, series) = self.Mirrored(seriesname)
+        if seasonnum is None:
+            return ShowText(series)
+        return EpisodeText(series, self.mirror.Episode(sid, seasonnum, episodenum))
+
+    def Season(self, seriesname, seasonnum):
+        '''Return the series information and that of each episode of the
+           season in turn.
+        '''
+        if self.mirror is None:
+            with self.Lock(seriesname.lower()):
+                show = self.Show(seriesname)
+            season = show[seasonnum]
+            return (ShowRecord(show), [EpisodeRecord(season[episodenum])
+                                       for episodenum in sorted(season)])
+        (sid, series) = self.Mirrored(seriesname)
+        return (series, self.mirror.Season(sid, seasonnum))
+
+    def Episodes(self, season):
+        '''Pool task: return the information of each episode of the
+           (series name, season number) in turn, or None if not found.
+        '''
+        try:
+            return self.Season(*season)[1]
+        except failures as error:
+            sys.stderr.write("%s season %d: %s\n" % (season[0], season[1], error))
+            return None
+
+    def Query(self, line):
+        '''Return the printout & error message (either None) for a query.'''
+        try:
+            query = ParseQuery(line)
+            if query is None:
+                return (None, None)
+            return (self.Lookup(*query), None)
+        except failures + (ValueError,) as error:
+            return (None, "%s: %s\n" % (line.strip(), error))
+
+
+def Batch(lookup, queries, jobs):
+    '''Print the information for each query line in turn, looking them up
+       in a pool of threads, returning the number of failed queries.
+    '''
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, jobs))
+    failed = 0
+    try:
+        for (text, error) in pool.imap(lookup.Query, queries):
+            if text is not None:
+                Output(text)
+            if error is not None:
+                sys.stdout.flush()
+                sys.stderr.write(error)
+                failed += 1
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.flush()
+    return failed
+
+
+def RefreshAll(lookup, jobs):
+    '''Check every series in the mirror for changes, in a pool of threads,
+       fetching only those changed, returning the number fetched.
+    '''
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, jobs))
+    try:
+        return sum(pool.map(lookup.Refresh, lookup.mirror.Sids()))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Episode ids in media file names: <series>.<season>x<episode>[.<title>][.Part.<part>].<ext>
+EPISODE = re.compile(r'^(?P<series>.+?)\.(?P<season>\d+)x(?P<episode>\d+)'
+                     r'(?:\.(?P<title>.+?))?(?:\.Part\.(?P<part>\d+))?\.[^.]+$')
+# Parts in episode names: <title> (<part>)
+PART = re.compile(r'^(?P<title>.*?)\s*\((?P<part>\d+)\)$')
+
+
+def EpisodeFiles(paths):
+    '''Find the media files (and '.meta' files) named with episode ids in
+       the paths, returning the (series name, season, episode, title, part)
+       of each '.meta' file, by filename.
+    '''
+    names = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                names.extend([os.path.join(dirpath, name) for name in sorted(filenames)])
+        else:
+            names.append(path)
+    episodes = {}
+    for name in names:
+        (dirpath, name) = os.path.split(name)
+        if name.startswith('.') and name.endswith('.meta'):
+            name = name[1:-5]
+        elif name.startswith('.'):
+            continue
+        match = EPISODE.match(name)
+        if match is not None:
+            part = match.group('part')
+            episodes[os.path.join(dirpath, '.' + name + '.meta')] = (
+                match.group('series').replace('.', ' '), int(match.group('season')),
+                int(match.group('episode')), match.group('title') or '',
+                part and int(part))
+    return episodes
+
+
+def Simplified(title):
+    '''Reduce a title to lower case letters & digits, for comparing.'''
+    return re.sub(r'[^a-z0-9]', '', title.lower())
+
+
+def FindEpisode(episodes, episodenum, title, part):
+    '''Find the information of a file's episode among those of its season.
+       Without a part, it is the numbered episode.  With one, the episode
+       named "<title> (<part>)" for the file's title, or failing that, the
+       part of the numbered story (counting stories by their titles).
+    '''
+    if part is None:
+        for episode in episodes:
+            if dict(episode).get('episodenumber', None) == unicode(episodenum):
+                return episode
+        return None
+    stories = []
+    parts = {}
+    for episode in episodes:
+        match = PART.match(dict(episode).get('episodename', None) or '')
+        if match is not None:
+            story = Simplified(match.group('title'))
+            if story not in stories:
+                stories.append(story)
+            parts[(story, int(match.group('part')))] = episode
+    story = Simplified(title)
+    if (story, part) not in parts and 0 < episodenum <= len(stories):
+        story = stories[episodenum-1]
+    return parts.get((story, part), None)
+
+
+def BroadcastLines(lines, firstaired):
+    '''Return the '.meta' file lines with the broadcast date set to
+       firstaired (in place of any other), or None if it already is.
+    '''
+    result = []
+    placed = False
+    for line in lines:
+        record = line.rstrip('\n').split(':')
+        if len(record) > 1:
+            if record[0].isalpha() or (record[0].find('|') >= 0 and not record[1].isalpha()):
+                (pos, value) = (0, record[1])
+            else:
+                (pos, value) = (1, record[0])
+            taglist = record[pos].split('|')
+            if 'broadcast' in taglist:
+                if value.split('@')[0] == firstaired:
+                    return None
+                if not placed:
+                    result.append(firstaired + ':broadcast\n')
+                    placed = True
+                taglist.remove('broadcast')
+                if not taglist:
+                    continue
+                record[pos] = '|'.join(taglist)
+                line = ':'.join(record) + '\n'
+        result.append(line)
+    if not placed:
+        result.insert(0, firstaired + ':broadcast\n')
+    return result
+
+
+def WriteMeta(filename, lines):
+    '''Write the '.meta' file, keeping any previous version as the next
+       backup version (eg: '.meta.3' after '.meta.2').
+    '''
+    tmpname = filename + '.tmp'
+    file = open(tmpname, 'w')
+    try:
+        file.writelines(lines)
+    finally:
+        file.close()
+    if os.path.exists(filename):
+        (dirpath, name) = os.path.split(filename)
+        versions = [int(other[len(name)+1:]) for other in os.listdir(dirpath or '.')
+                    if other.startswith(name + '.') and other[len(name)+1:].isdigit()]
+        os.rename(filename, "%s.%d" % (filename, max(versions + [-1]) + 1))
+    os.rename(tmpname, filename)
+
+
+def Generate(lookup, paths, jobs, debug=False):
+    '''Fill in (or update) the broadcast date of the '.meta' file of each
+       media file named with an episode id in the paths, fetching each
+       series once, returning the number of files not matched to episodes.
+       Only files whose content changes are written.
+    '''
+    from multiprocessing.pool import ThreadPool
+    episodes = EpisodeFiles(paths)
+    seasons = sorted(set([(episode[0], episode[1]) for episode in episodes.values()]))
+    pool = ThreadPool(max(1, jobs))
+    try:
+        seasons = dict(zip(seasons, pool.map(lookup.Episodes, seasons)))
+    finally:
+        pool.close()
+        pool.join()
+    (written, unchanged, unmatched) = (0, 0, 0)
+    for filename in sorted(episodes):
+        (seriesname, seasonnum, episodenum, title, part) = episodes[filename]
+        episode = None
+        if seasons[(seriesname, seasonnum)] is not None:
+            episode = FindEpisode(seasons[(seriesname, seasonnum)], episodenum, title, part)
+        firstaired = episode and dict(episode).get('firstaired', None)
+        if not firstaired:
+            sys.stderr.write("No broadcast date for %s\n" % filename)
+            unmatched += 1
+            continue
+        lines = []
+        if os.path.exists(filename):
+            file = open(filename, 'r')
+            lines = file.readlines()
+            file.close()
+        lines = BroadcastLines(lines, str(firstaired))
+        if lines is None:
+            unchanged += 1
+            continue
+        if debug:
+            sys.stderr.write("Writing %s\n" % filename)
+        WriteMeta(filename, lines)
+        written += 1
+    sys.stderr.write("%d written, %d unchanged, %d without dates\n" %
+                     (written, unchanged, unmatched))
+    return unmatched
+
 
 def main():
 # Process arguments
-    parser = OptionParser(usage=u"%prog -dhiuv <seriesname> [<seasonnumber> <episodenumber>]")
+    parser = OptionParser(usage=u"%prog -dghiouvR [-j <jobs>] [-m <mirror>] [-S <megabytes>] [-t <hours>] [-U <url>] <seriesname> [<seasonnumber> <episodenumber>] | -b <queryfile>")
+    parser.add_option( "-b", "--batch", metavar="QUERYFILE", default=None,
+                       dest="batch",
+                       help=u"Look up each query line of the file ('-' for stdin)")
     parser.add_option( "-d", "--debug", action="store_true", default=False,
                        dest="debug",
                        help=u"Show debugging info")
+    parser.add_option( "-g", "--generate", action="store_true", default=False,
+                       dest="generate",
+                       help=u"Fill in the broadcast dates of '.meta' files for media files")
     parser.add_option( "-i", "--interactive", action="store_true", default=False,
                        dest="interactive",
                        help=u"Activate the tvdb_api interactive mode\n(allows prompted selection from matching series")
+    parser.add_option( "-j", "--jobs", metavar="JOBS", type="int", default=4,
+                       dest="jobs",
+                       help=u"Number of batch queries looked up at a time")
+    parser.add_option( "-m", "--mirror", metavar="MIRROR", default='~/.meta.db',
+                       dest="mirror",
+                       help=u"Database file for the local mirror ('' for none)")
+    parser.add_option( "-o", "--offline", action="store_true", default=False,
+                       dest="offline",
+                       help=u"Only use the mirror, never the TVDB site")
+    parser.add_option( "-R", "--refresh", action="store_true", default=False,
+                       dest="refresh",
+                       help=u"Fetch the mirrored shows updated on TVDB")
+    parser.add_option( "-S", "--size", metavar="MEGABYTES", type="float", default=64,
+                       dest="size",
+                       help=u"Size limit of the mirror")
+    parser.add_option( "-t", "--ttl", metavar="HOURS", type="float", default=24,
+                       dest="ttl",
+                       help=u"Time to use mirrored shows before checking for updates")
+    parser.add_option( "-U", "--url", metavar="URL", default=None,
+                       dest="url",
+                       help=u"Base URL of the TVDB site (eg: a local stand-in)")
     parser.add_option( "-u", "--usage", action="store_true", default=False,
                        dest="usage",
                        help=u"Display examples for executing the meta script")
@@ -155,6 +811,50 @@ def main():
         sys.stdout.write(usage_examples)
         sys.exit(0)
 
+# Set up the lookups, consulting the mirror first (if any) & only
+# connecting to the database if need be
+    mirror = None
+    if opts.mirror:
+        mirror = Mirror(os.path.expanduser(opts.mirror), opts.ttl * 3600,
+                        opts.size * 1024 * 1024)
+    elif opts.offline or opts.refresh:
+        parser.error("Must have a mirror to be offline or refresh it!")
+    lookup = Lookup(lambda: Connect(opts.interactive, mirror is None, opts.url),
+                    mirror, opts.offline)
+
+# Refresh the mirror?
+    if opts.refresh:
+        if opts.offline:
+            parser.error("Cannot refresh the mirror offline!")
+        fetched = RefreshAll(lookup, opts.jobs)
+        sys.stderr.write("%d shows updated\n" % fetched)
+        mirror.Close()
+        sys.exit(0)
+
+# Generate '.meta' files?
+    if opts.generate:
+        if len(args) == 0:
+            parser.error("Must supply at least one media path!")
+        unmatched = Generate(lookup, args, opts.jobs, opts.debug)
+        if mirror is not None:
+            mirror.Close()
+        sys.exit(unmatched and 1 or 0)
+
+# Batch of queries?
+    if opts.batch is not None:
+        if opts.interactive:
+            parser.error("Cannot be interactive in batch mode!")
+        if args:
+            parser.error("No series name allowed in batch mode!")
+        if opts.batch == '-':
+            queries = sys.stdin
+        else:
+            queries = open(opts.batch, 'r')
+        failed = Batch(lookup, queries, opts.jobs)
+        if mirror is not None:
+            mirror.Close()
+        sys.exit(failed and 1 or 0)
+
 # Check for required arguments
     if len(args) == 0:
         parser.error("Must supply at least a series name!")
@@ -180,24 +880,15 @@ def main():
         else:
             parser.error("Episode number must be numeric!")
 
-# Connect to database
-    tvdb = Tvdb(interactive=opts.interactive, cache=True)
-
 # Process query
-    show = tvdb[seriesname]
-    if seasonnum is None:
-        print show['seriesname'] + ":"
-        for key in show.data.keys():
-            if key != 'seriesname':
-                print "\t" + key + ": ",
-                print show[key]
-    else:
-        episode = show[seasonnum][episodenum]
-        print show['seriesname'] + " " + episode['episodename'] + ":"
-        for key in episode.keys():
-            if key != 'episodename':
-                print "\t" + key + ": ",
-                print episode[key]
+    try:
+        Output(lookup.Lookup(seriesname, seasonnum, episodenum))
+    except failures as error:
+        sys.stderr.write("%s: %s\n" % (seriesname, error))
+        sys.exit(1)
+    finally:
+        if mirror is not None:
+            mirror.Close()
 
 # Finished
     sys.exit(0)
@@ -11,36 +11,114 @@
 #	using differences calculated from files with both source & target data.
 #	By default it estimates AU date based upon generic broadcast date.
 # OPTIONS
+#	-B FROM TO, --between FROM TO
+#				output only the files with a date for the tag
+#				(see -g) from FROM to TO (YYYY-MM-DD), found in
+#				the index (see -I), by date.
+#	-b, --basename		Output file names without their directories
+#				or leading dot (of hidden '.meta' files).
+#	-c CACHEFILE, --cache=CACHEFILE
+#				file to keep parsed metadata in between runs,
+#				only changed files are parsed again (default: none).
 #	-d, --debug		Show debugging info.
+#	-e ENGINE, --engine=ENGINE
+#				engine for estimating: numpy (vectorized) or python
+#				(default: numpy if it is installed, unless
+#				estimating from the nearest episodes, else python).
+#	-f FORMAT, --format=FORMAT
+#				output format: text ("file:date" lines), jsonl
+#				(a JSON object per file), csv or tsv (with a
+#				header line), the data columns named "date" &
+#				"delta" or "source:target" (default: text).
+#				Bad dates are reported on stderr rather than
+#				with the output, other than as text.
+#	-g TAG, --tag=TAG	tag of the dates for -B (default: the target).
+#	-H TAG, --has-tag=TAG	output only the files with a date for the tag,
+#				found in the index (see -I), by date. Only the
+#				tags of dates are indexed, not trailing fields
+#				such as the network (eg: ABC).
 #	-h, --help		Display help message.
-#	-M YYYY-MM-DD, --metadate=YYYY-MM-DD
+#	-I INDEXFILE, --index=INDEXFILE
+#				file to keep an index of the files by tag &
+#				date in (the target dates as output, estimated
+#				where need be), for querying with -B & -H.
+#				Written after each run, and before a query if
+#				missing or made with other options or paths.
+#	-i SECONDS, --interval=SECONDS
+#				time between checks for changes when watching,
+#				without inotify (default: 5).
+#	-j JOBS, --jobs=JOBS	number of processes for scanning & parsing
+#				the metadata files (default: 1).
+#	-M YYYY-MM-DD[,...], --metadate=YYYY-MM-DD[,...]
 #				maximum date allowed for '.meta' files,
 #				otherwise use backup versions (default: none).
+#				Several dates give the output as at each date,
+#				labelled with the date, from a single scan.
+#	-m SHARDFILE, --map=SHARDFILE
+#				only write the partial delta sums & counts of
+#				each path prefix, the known dates and the files
+#				left to estimate of the paths (a shard of the
+#				library) to the file, for merging with -r.
+#	-n, --nearest		Estimate missing dates by interpolating between
+#				the deltas of the nearest episodes either side
+#				(by the season, episode & part in the file
+#				names) in the same directory, rather than the
+#				average delta of the directory (with the
+#				python engine only).
+#	-O ORDER, --sort=ORDER	output sorted by date (then path) or path
+#				(default: none, as found).
 #	-o, --override		Override approximate dates with their estimate
-#	-s SOURCE, --source=SOURCE
+#	-P PACKFILE, --pack=PACKFILE
+#				read the directory hierarchies from a pack file
+#				(made with -R) instead of listing directories &
+#				opening each file (default: none).
+#	-Q SOCKET, --serve=SOCKET
+#				answer queries on a Unix socket, keeping the
+#				dates up to date as when watching: each line
+#				sent is a file or directory path, answered with
+#				the output for it (or all files under it) and
+#				an empty line.
+#	-R, --repack		(Re)build the pack file from the directory
+#				hierarchies first, only reading the files
+#				changed since it was last built.
+#	-r, --reduce		Merge the shard files given (from -m) and
+#				output the dates of all their files, as a
+#				single run over all the shards would.
+#				The shards must not overlap, and their paths
+#				be relative to the same place.
+#	-S, --stream		Output in path order as soon as each date is known,
+#				keeping only the open directories in memory.
+#	-s SOURCE[,...], --source=SOURCE[,...]
 #				Code to use as base (default: broadcast).
-#	-t TARGET, --target=TARGET
+#	-T, --stats		Report phase timings & counters on stderr.
+#	--stats-json		Report phase timings & counters as JSON.
+#	-t TARGET[,...], --target=TARGET[,...]
 #				Code for locality to display (default: AU).
+#				Several sources and/or targets are estimated
+#				together, one column per source & target pair
+#				(sources outermost, skipping matching pairs).
 #	-u, --usage		Display examples for executing the shown script.
 #	-v, --version		Display version and author.
+#	-w, --watch		Keep watching for changed metadata after output,
+#				then output any changed dates.
 # AUTHOR
 #	Peter Lyons
 # IMPLEMENTATION
+#	The Engine class does the scanning, parsing, estimating, querying,
+#	sharding, streaming & watching, for use as a module too, eg:
+#	engine = shown.Engine('broadcast', 'AU'); engine.Load(['data'])
+#	engine.Query('data/Season 1987.24')
 # GLOBALS
 #	usage_description	initial usage text - basic summary
 #	usage_examples		ending usage text - contains command examples
-#	opts		parsed options information
-#	opts.debug		print debugging info?
-#	opts.override		override approximate dates with an estimate?
-#	opts.usage		print usage info?
-#	opts.version		print version and author info?
+#	stats		phase timings & counters (reported with -T)
 #
 
 
 """Show TV episodes AU broadcast dates."""
 __title__ = "Broadcast Date Display Utility"
 __author__ = "darklion"
-__version__ = "0.5.2"
+__version__ = "0.7.5"
 # Version 0.1	Initial development skeleton
 # Version 0.1.1	Basic metadata processing with no actual estimating
 # Version 0.1.2	Make source and target of the estimating variable
@@ -64,6 +142,29 @@ __version__ = "0.5.2"
 # Version 0.5.0	Allow override of approximate dates with estimate (first cut)
 # Version 0.5.1	When overriding, only report on dates with values/estimates
 # Version 0.5.2	Bug fixes: find latest file when metadate set and handle bad tag values
+# Version 0.5.3	Keep running delta sums & counts in the tree rather than re-summing leaves
+# Version 0.5.4	Optionally cache parsed metadata between runs, keyed by file stat
+# Version 0.5.5	Optionally scan & parse using a pool of processes
+# Version 0.5.6	Optionally keep watching for changes & re-estimate affected files only
+# Version 0.5.7	Optionally stream output in path order with bounded memory
+# Version 0.5.8	Reuse immutable parsed dates for repeated date strings
+# Version 0.5.9	Index backup versions by modify date & allow several metadates
+# Version 0.6.0	Estimate several sources & targets together, output in columns
+# Version 0.6.1	Optionally report phase timings & counters, with hooks for monitoring
+# Version 0.6.2	Keep parsed metadata & estimates in compact columns, not dicts per file
+# Version 0.6.3	Optionally estimate with NumPy array reductions over path prefix groups
+# Version 0.6.4	Optionally serve queries on a Unix socket, kept up to date as when watching
+# Version 0.6.5	Move scanning, parsing, estimating & querying into an importable engine
+# Version 0.6.6	Optionally read the metadata hierarchies from a memory mapped pack file
+# Version 0.6.7	Buffered output as text, JSON lines, CSV or TSV, optionally sorted
+# Version 0.6.8	Optionally keep an index of files by tag & date for range queries
+# Version 0.6.9	Optionally sum up shards separately & merge them to estimate (map/reduce)
+# Version 0.7.0	Optionally estimate from the nearest episodes by a sorted index per directory
+# Version 0.7.1	Move streaming, watching, sharding & index queries onto the engine too
+# Version 0.7.2	Find paths in the pack file however they are spelt
+# Version 0.7.3	Keep bad date reports out of JSON lines, CSV & TSV output
+# Version 0.7.4	Report a missing delta as an error, not a TypeError
+# Version 0.7.5	Refuse to keep an index when streaming
 
 usage_description = '''
 This script displays TV Show Broadcast Dates using data from the supplied files.
@@ -73,38 +174,198 @@ usage_examples = '''
 Command examples:
 > shown data/Season\ 198*/.*.meta
 > shown -t AU data/Season\ 1987.*/.*.meta
+> shown -Q /tmp/shown.sock data &
+> shown -R -P data.pack data
+> shown -b -O date -f csv data
+> shown -I data.idx -B 1976-01-01 1978-12-31 -g AU data
+> shown -I data.idx -H au data
+> shown -m 1.shard data/Season\ 197* ; shown -m 2.shard data/Season\ 198*
+> shown -r 1.shard 2.shard
 '''
 
 # System modules
+import bisect
+import cPickle
+import csv
+import heapq
+import json
+import mmap
+import multiprocessing
 import os
+import re
+import SocketServer
+import stat
+import struct
+import StringIO
 import sys
+import threading
+import time
+from array import array
 from datetime import date, datetime, timedelta
 from optparse import OptionParser
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 class ExtDate(date):
-    ''' Wraps Date class to allow for extra attributes.'''
+    ''' Wraps Date class to allow for extra (read-only) attributes.
+        Instances are immutable, so parsed dates can be shared freely.
+    '''
+    __slots__ = ()
+    isEstimate = False
+
+
+class EstDate(ExtDate):
+    ''' An ExtDate with missing parts filled in by estimating.'''
+    __slots__ = ()
+    isEstimate = True
+
+
+# Missing date parts lookup
+MONTHS = {'0?': '05', '1?': '11'}
+DAYS   = {'??': '15', '0?': '05', '1?': '15', '2?': '25', '3?': '30'}
+# Parsed dates, by date string
+DATE_CACHE_SIZE = 10000
+dates = {}
+
+
+class Stats(object):
+    ''' Phase timings (wall & CPU seconds) and counters for a run.
+        Hooks added with AddStatsHook are called with the Summary
+        at the end of the run (and after each change when watching).
+    '''
+    def __init__(self):
+        self.phases = []
+        self.counters = {}
+        self.started = None
+
+    def Count(self, name, amount=1):
+        '''Add to the named counter.'''
+        self.counters[name] = self.counters.get(name, 0) + amount
 
+    def Reset(self):
+        '''Start afresh, eg: for each change when watching.'''
+        self.phases = []
+        self.counters = {}
+        self.started = None
 
-def ParseDate(value):
-    '''Extract a legitimate date from the generalized date string.'''
-# Init missing parts lookup
-    monthdict = {'0?': '05', '1?': '11'}
-    daydict   = {'??': '15', '0?': '05', '1?': '15', '2?': '25', '3?': '30'}
+    def Start(self, phase):
+        '''Start timing a phase, finishing any phase being timed.'''
+        self.Stop()
+        self.started = (phase, time.time(), sum(os.times()[:4]))
+
+    def Stop(self):
+        '''Finish timing the current phase, if any.'''
+        if self.started is not None:
+            (phase, wall, cpu) = self.started
+            (wall, cpu) = (time.time() - wall, sum(os.times()[:4]) - cpu)
+            for timing in self.phases:
+                if timing[0] == phase:
+                    timing[1] += wall
+                    timing[2] += cpu
+                    break
+            else:
+                self.phases.append([phase, wall, cpu])
+            self.started = None
+
+    def Summary(self):
+        '''Return the phase timings & counters as plain data.'''
+        self.Stop()
+        return {'phases': [{'phase': phase, 'wall': wall, 'cpu': cpu}
+                           for (phase, wall, cpu) in self.phases],
+                'counters': dict(self.counters)}
+
+    def Report(self, asjson=False):
+        '''Output the phase timings & counters on stderr, as text or JSON.'''
+        summary = self.Summary()
+        if asjson:
+            sys.stderr.write(json.dumps(summary, sort_keys=True) + '\n')
+            return
+        for phase in summary['phases']:
+            sys.stderr.write("%-24s %9.3fs wall %9.3fs cpu\n" %
+                             (phase['phase'], phase['wall'], phase['cpu']))
+        for name in sorted(summary['counters']):
+            sys.stderr.write("%-24s %10d\n" % (name, summary['counters'][name]))
+
+    def Finish(self):
+        '''Pass the phase timings & counters to the hooks.'''
+        summary = self.Summary()
+        for hook in hooks:
+            hook(summary)
+
+
+# Run statistics & the hooks to pass them to
+stats = Stats()
+hooks = []
+
+
+def AddStatsHook(hook):
+    '''Have hook(summary) called with the phase timings & counters (see
+       Stats.Summary) at the end of each run, eg: to feed monitoring.
+    '''
+    hooks.append(hook)
+
+
+# Where the problems reported with the output go (None for stdout)
+warnout = None
+
+
+def WarnTo(stream):
+    '''Report the problems otherwise reported with the output (on stdout)
+       on the stream instead, eg: stderr when the output is machine readable.
+    '''
+    global warnout
+    warnout = stream
+
+
+def Warn(text, log=None, out=False, kind=None):
+    '''Report a metadata problem (on stderr, or with the output if out is
+       set), or save it in the log to be reported later.
+       The kind of problem, if given, is counted when reported.
+    '''
+    if log is not None:
+        log.append((out, text, kind))
+        return
+    if kind is not None:
+        stats.Count(kind)
+    if out:
+        (warnout or sys.stdout).write(text)
+    else:
+        sys.stderr.write(text)
+
+
+def ConvertDate(value, log=None):
+    '''Convert the generalized date string to a legitimate date.'''
 # Get three parts of the date
     parts = value.split('-')
     while len(parts) < 3:
         parts.append('')
+    if len(parts) > 3:
+        Warn(value+'='+str(parts)+'\n', log, True, 'bad_dates')
+        return None
     [year, month, day] = parts
 # Check for optional time
     daytime = day.split('@')
     if len(daytime) > 1:
-        (day, time) = (daytime[0], daytime[1])
+        day = daytime[0]
         parts[-1:] = daytime
 # Handle missing parts
     isEstimate = False
     if not month.isdigit():
-        match = monthdict.get(month, None)
+        match = MONTHS.get(month, None)
         if match is None:
             month = '06'
             day   = '30'
@@ -112,27 +373,47 @@ def ParseDate(value):
             month = match
         isEstimate = True
     if not day.isdigit():
-        match = daydict.get(day, None)
-        if match is None:
-            day   = '15'
-        else:
-            day   = match
+        day = DAYS.get(day, '15')
         isEstimate = True
     try:
-        match = ExtDate(int(year), int(month), int(day))
-        match.isEstimate = isEstimate
+        if isEstimate:
+            match = EstDate(int(year), int(month), int(day))
+        else:
+            match = ExtDate(int(year), int(month), int(day))
     except:
-        print value+'='+str(parts)
+        Warn(value+'='+str(parts)+'\n', log, True, 'bad_dates')
         match = None
     return match
 
 
-def ParseMeta(filename):
-    '''Extract metadata date information from the file.'''
-    file = open(filename, 'r')
+def ParseDate(value, log=None):
+    '''Extract a legitimate date from the generalized date string,
+       reusing the date from any previous parse of the same string.
+    '''
+    match = dates.get(value, None)
+    if match is None:
+        match = ConvertDate(value, log)
+        if match is not None:
+            if len(dates) >= DATE_CACHE_SIZE:
+                dates.clear()
+            dates[value] = match
+    return match
+
+
+def ParseMeta(filename, log=None, pack=None):
+    '''Extract metadata date information from the file (or its copy in the
+       pack, if there is one).
+    '''
+    file = None
+    if pack is not None:
+        source = pack.Lines(filename)
+    if pack is None or source is None:
+        file = source = open(filename, 'r')
     # Build metadata object
     info = {}
-    for line in file:
+    lines = 0
+    for line in source:
+        lines += 1
         line = line.rstrip()
         record = line.split(':')
         if len(record) > 1:
@@ -147,145 +428,2063 @@ def ParseMeta(filename):
                 pos = 1
             else:
                 taglist = record[1].split('|')
-            value = ParseDate(record[pos])
+            value = ParseDate(record[pos], log)
             for tag in taglist:
                 if tag.isalpha() and value is not None:
                     info[tag] = value
                 elif tag.isalpha():
-                    sys.stderr.write('Bad value for tag "'+tag+'" in '+filename+'\n')
+                    Warn('Bad value for tag "'+tag+'" in '+filename+'\n', log,
+                         False, 'bad_values')
                 else:
-                    sys.stderr.write('Bad tag "'+tag+'" in '+filename+'\n')
-    file.close
+                    Warn('Bad tag "'+tag+'" in '+filename+'\n', log,
+                         False, 'bad_tags')
+    if file is not None:
+        file.close()
+    stats.Count('files_parsed')
+    stats.Count('lines_parsed', lines)
+    return info
+
+
+def StatSignature(filename):
+    '''Return the (modify time, size) signature of the file.'''
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+
+def PackInfo(info):
+    '''Flatten file metadata into plain values for storing.'''
+    return [(tag, value.toordinal(), value.isEstimate) for (tag, value) in info.items()]
+
+
+def UnpackInfo(packed):
+    '''Rebuild file metadata from its stored values.'''
+    info = {}
+    for (tag, ordinal, isEstimate) in packed:
+        if isEstimate:
+            info[tag] = EstDate.fromordinal(ordinal)
+        else:
+            info[tag] = ExtDate.fromordinal(ordinal)
     return info
 
 
+class MetaCache(object):
+    ''' Persistent store of parsed file metadata.
+        Entries are keyed by filename and only used while the file's
+        stat signature (modify time & size) is unchanged.
+    '''
+    VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        self.seen = set()
+        self.dirty = False
+        try:
+            file = open(filename, 'rb')
+            try:
+                store = cPickle.load(file)
+            finally:
+                file.close()
+            if store.get('version', None) == self.VERSION:
+                self.files = store['files']
+        except Exception:
+        # Missing or unreadable cache - start afresh
+            self.dirty = True
+
+    def Get(self, filename, signature):
+        '''Return the stored (packed metadata, problem log) for the file,
+           or None if it has changed since it was stored.
+        '''
+        self.seen.add(filename)
+        entry = self.files.get(filename, None)
+        if entry is None or entry[0] != signature:
+            return None
+        return entry[1:]
+
+    def Store(self, filename, signature, packed, log):
+        '''Remember the packed metadata & problem log for the file.'''
+        self.seen.add(filename)
+        self.files[filename] = (signature, packed, log)
+        self.dirty = True
+
+    def Save(self):
+        '''Evict entries for deleted files and write the cache if changed.'''
+        for filename in self.files.keys():
+            if filename not in self.seen and not os.path.exists(filename):
+                del self.files[filename]
+                self.dirty = True
+        if not self.dirty:
+            return
+        tmpname = self.filename + '.tmp'
+        file = open(tmpname, 'wb')
+        try:
+            cPickle.dump({'version': self.VERSION, 'files': self.files},
+                         file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+        os.rename(tmpname, self.filename)
+        self.dirty = False
+
+
+class Pack(object):
+    ''' Read only view of a pack file: the metadata file revisions of some
+        directory hierarchies (names & signatures by directory) and their
+        contents, in one file read through a memory map.
+        The file is the magic string, the contents, the pickled index and
+        the offset of the index.  The paths are kept normalised, and looked
+        up however they are spelt.
+    '''
+    MAGIC = 'SHOWNPK\x01'
+
+    def __init__(self, filename):
+        self.filename = filename
+        file = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        if self.data[:len(self.MAGIC)] != self.MAGIC:
+            self.data.close()
+            raise ValueError("Not a pack file: %s" % filename)
+        (offset,) = struct.unpack('<Q', self.data[-8:])
+        index = cPickle.loads(self.data[offset:-8])
+        self.tops = index['tops']
+        self.dirs = index['dirs']
+        self.contents = {}
+        for (dirpath, (files, dirs)) in self.dirs.iteritems():
+            for (name, signature, start, end) in files:
+                self.contents[os.path.join(dirpath, name)] = (signature, start, end)
+
+    def Entry(self, filename):
+        '''Return the (signature, start, end) of a packed file, or None.'''
+        entry = self.contents.get(filename, None)
+        if entry is None:
+            entry = self.contents.get(os.path.normpath(filename), None)
+        return entry
+
+    def Lines(self, filename):
+        '''Return the lines of a packed file (sliced from the memory map),
+           or None if not packed.
+        '''
+        entry = self.Entry(filename)
+        if entry is None:
+            return None
+        return self.Split(entry[1], entry[2])
+
+    def Split(self, start, end):
+        '''Generate the lines between the offsets, the way a file would.'''
+        data = self.data
+        while start < end:
+            pos = data.find('\n', start, end)
+            if pos < 0:
+                pos = end - 1
+            yield data[start:pos+1]
+            start = pos + 1
+
+    def Content(self, filename, signature):
+        '''Return the content of a packed file, or None if it has changed.'''
+        entry = self.Entry(filename)
+        if entry is None or entry[0] != signature:
+            return None
+        return self.data[entry[1]:entry[2]]
+
+    def Scanned(self, tops, wantdates, scanned=None):
+        '''Index the packed metadata file revisions of each directory
+           hierarchy the way ScanTree would, the paths spelt as given.
+        '''
+        if scanned is None:
+            scanned = {}
+        for top in tops:
+            packed = os.path.normpath(top)
+            if packed not in self.dirs:
+                raise ValueError("Not in pack %s: %s" % (self.filename, top))
+            stack = [(packed, top)]
+            while stack:
+                (packed, dirpath) = stack.pop()
+                (files, dirs) = self.dirs[packed]
+                stats.Count('dirs_unpacked')
+                subdirs = dirs
+                if dirpath != packed:
+                    subdirs = [os.path.join(dirpath, os.path.basename(subdir))
+                               for subdir in dirs]
+                scanned[dirpath] = (RevisionIndex(dirpath, [
+                    (name, signature) for (name, signature, start, end) in files],
+                    wantdates), subdirs)
+                stack.extend(zip(dirs, subdirs))
+        return scanned
+
+    def Close(self):
+        '''Unmap the pack file.'''
+        self.data.close()
+
+
+def WritePack(filename, tops, pool=None, jobs=1):
+    '''Write the metadata file revisions of each directory hierarchy and
+       their contents to the pack file, reusing the contents of files
+       unchanged since any previous pack rather than reading them again.
+    '''
+    try:
+        old = Pack(filename)
+    except (IOError, EnvironmentError, ValueError, EOFError, cPickle.UnpicklingError):
+        old = None
+    tops = [os.path.normpath(top) for top in tops]
+    scanned = ScanTree(tops, True, True, pool, jobs)
+    tmpname = filename + '.tmp'
+    file = open(tmpname, 'wb')
+    try:
+        file.write(Pack.MAGIC)
+        offset = len(Pack.MAGIC)
+        dirs = {}
+        for dirpath in sorted(scanned):
+            (index, subdirs) = scanned[dirpath]
+            revisions = []
+            for (fullname, signature, mdate, mdates, backups) in index:
+                revisions.append((fullname, signature))
+                revisions.extend(backups)
+            files = []
+            for (fullname, signature) in revisions:
+                content = None
+                if old is not None:
+                    content = old.Content(fullname, signature)
+                if content is None:
+                    try:
+                        source = open(fullname, 'rb')
+                        try:
+                            content = source.read()
+                        finally:
+                            source.close()
+                    except IOError:
+                        continue
+                    stats.Count('files_packed')
+                else:
+                    stats.Count('files_repacked')
+                file.write(content)
+                files.append((os.path.basename(fullname), signature,
+                              offset, offset + len(content)))
+                offset += len(content)
+            dirs[dirpath] = (files, subdirs)
+        cPickle.dump({'tops': list(tops), 'dirs': dirs}, file,
+                     cPickle.HIGHEST_PROTOCOL)
+        file.write(struct.pack('<Q', offset))
+    finally:
+        file.close()
+        if old is not None:
+            old.Close()
+    os.rename(tmpname, filename)
+
+
+class MetaTable(object):
+    ''' Compact column store of parsed file metadata, indexed by file id.
+        The dates of each file are a run of cells (tag id, date ordinal &
+        estimate flag) held in arrays, with the tag names interned, so no
+        objects are kept per file other than its name.
+    '''
+    def __init__(self):
+        self.filenames = []
+        self.ids = {}
+        self.tagnames = []
+        self.tagids = {}
+        self.starts = array('l', [0])
+        self.tags = array('H')
+        self.ordinals = array('l')
+        self.flags = array('b')
+
+    def TagId(self, tag):
+        '''Return the id of the tag name, interning any new name.'''
+        tagid = self.tagids.get(tag, None)
+        if tagid is None:
+            tagid = len(self.tagnames)
+            tag = intern(tag)
+            self.tagnames.append(tag)
+            self.tagids[tag] = tagid
+        return tagid
+
+    def Add(self, filename, info):
+        '''Store the file metadata, returning the file's id.'''
+        fileid = len(self.filenames)
+        self.filenames.append(filename)
+        self.ids[filename] = fileid
+        for (tag, value) in info.iteritems():
+            self.tags.append(self.TagId(tag))
+            self.ordinals.append(value.toordinal())
+            self.flags.append(value.isEstimate)
+        self.starts.append(len(self.tags))
+        return fileid
+
+    def Info(self, fileid):
+        '''Rebuild the metadata of the file as a dict of dates.'''
+        return UnpackInfo([(self.tagnames[self.tags[cell]], self.ordinals[cell],
+                            self.flags[cell])
+                           for cell in xrange(self.starts[fileid],
+                                              self.starts[fileid+1])])
+
+    def Column(self, tag):
+        '''Return the date ordinals (0 if missing) & estimate flags of the
+           tag, by file id.
+        '''
+        ordinals = array('l', [0]) * len(self.filenames)
+        flags = array('b', [0]) * len(self.filenames)
+        tagid = self.tagids.get(tag, None)
+        if tagid is None:
+            return (ordinals, flags)
+        (starts, tags) = (self.starts, self.tags)
+        for fileid in xrange(len(self.filenames)):
+            for cell in xrange(starts[fileid], starts[fileid+1]):
+                if tags[cell] == tagid:
+                    ordinals[fileid] = self.ordinals[cell]
+                    flags[fileid] = self.flags[cell]
+        return (ordinals, flags)
+
+
+def CountedSince(before):
+    '''Return the (name, amount)s counted since the before copy of the counters.'''
+    return [(name, amount - before.get(name, 0))
+            for (name, amount) in stats.counters.items()
+            if amount != before.get(name, 0)]
+
+
+def PoolMap(func, items, pool=None, jobs=1):
+    '''Map the function over the items, in the process pool if there is one.'''
+    if pool is None:
+        return map(func, items)
+    return pool.map(func, items, max(1, len(items) // (jobs * 4)))
+
+
+def ListDir(dirpath, wantstat):
+    '''List the files of a directory (with their signatures, if wanted) and
+       the subdirectories to descend into, the way os.walk would.
+    '''
+    files = []
+    dirs = []
+    if scandir is not None:
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            return (files, dirs)
+        stats.Count('dirs_walked')
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+            elif wantstat:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = entry.stat(follow_symlinks=False)
+                stats.Count('files_stated')
+                files.append((entry.name, (st.st_mtime, st.st_size)))
+            else:
+                files.append((entry.name, None))
+    else:
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return (files, dirs)
+        stats.Count('dirs_walked')
+        stats.Count('files_stated', len(names))
+        for name in names:
+            fullname = os.path.join(dirpath, name)
+            try:
+                st = os.stat(fullname)
+            except OSError:
+                st = os.lstat(fullname)
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.islink(fullname):
+                    dirs.append(fullname)
+            else:
+                files.append((name, (st.st_mtime, st.st_size)))
+    return (files, dirs)
+
+
+def RevisionIndex(dirpath, files, wantdates):
+    '''Index the revisions of each metadata file in a directory listing:
+       the current '.meta' file and, if dates are wanted, its backup
+       versions (eg: '.meta.0') ordered by modify date.
+       Each entry is (filename, signature, modify date, backup modify dates,
+       backup (filename, signature)s), in filename order.
+    '''
+    episodes = {}
+    backups = []
+    for (name, signature) in files:
+        if name.endswith('.meta'):
+            mdate = None
+            if wantdates:
+                mdate = datetime.fromtimestamp(signature[0])
+            episodes[name] = (os.path.join(dirpath, name), signature, mdate, [], [])
+        elif wantdates:
+            backups.append((name, signature))
+# File each backup under the longest '.meta' file name it starts with
+    revisions = []
+    for (name, signature) in sorted(backups):
+        pos = name.rfind('.meta')
+        while pos >= 0 and name[:pos+5] not in episodes:
+            pos = name.rfind('.meta', 0, pos)
+        if pos >= 0:
+            revisions.append((datetime.fromtimestamp(signature[0]), name[:pos+5],
+                              os.path.join(dirpath, name), signature))
+    revisions.sort(key=lambda revision: revision[0])
+    for (mdate, name, fullname, signature) in revisions:
+        episodes[name][3].append(mdate)
+        episodes[name][4].append((fullname, signature))
+# Keep the revisions as tuples (mostly the shared empty tuple)
+    return [(fullname, signature, mdate, tuple(mdates), tuple(versions))
+            for (fullname, signature, mdate, mdates, versions)
+            in [episodes[name] for name in sorted(episodes)]]
+
+
+def SelectRevisions(index, metadate):
+    '''Choose the revision of each metadata file current at the metadate,
+       the latest backup version of any file modified after it.
+    '''
+    selected = []
+    for (fullname, signature, mdate, mdates, revisions) in index:
+        if not metadate or mdate <= metadate:
+            selected.append((fullname, signature))
+        else:
+            pos = bisect.bisect_right(mdates, metadate)
+            if pos > 0:
+                selected.append(revisions[pos-1])
+            stats.Count('backups_skipped', len(mdates) - pos)
+    return selected
+
+
+def ScanDir(task):
+    '''Pool task: list a directory and index its metadata file revisions,
+       also returning what was counted.
+    '''
+    (dirpath, wantstat, wantdates) = task
+    before = dict(stats.counters)
+    (files, dirs) = ListDir(dirpath, wantstat or wantdates)
+    return (RevisionIndex(dirpath, files, wantdates), dirs, CountedSince(before))
+
+
+def WalkOrder(tops, scanned, metadate=None):
+    '''Merge the metadata files current at the metadate from the scanned
+       directories of each hierarchy, in the order os.walk would find them.
+    '''
+    selections = []
+    for top in tops:
+        selected = []
+        stack = [top]
+        while stack:
+            (index, dirs) = scanned[stack.pop()]
+            selected.extend(SelectRevisions(index, metadate))
+            stack.extend(reversed(dirs))
+        selections.append(selected)
+    return selections
+
+
+def ScanTree(tops, wantstat, wantdates, pool=None, jobs=1, scanned=None):
+    '''Index the metadata file revisions (with their signatures, if wanted)
+       of each directory hierarchy, noting each directory's index and
+       subdirectories in scanned.
+       Each level of the hierarchies is scanned in the pool if there is one.
+    '''
+    if scanned is None:
+        scanned = {}
+    level = [top for top in tops]
+    while level:
+        tasks = [(dirpath, wantstat, wantdates) for dirpath in level
+                 if dirpath not in scanned]
+        level = []
+        for (task, result) in zip(tasks, PoolMap(ScanDir, tasks, pool, jobs)):
+            scanned[task[0]] = result[:2]
+            level.extend(result[1])
+            if pool is not None:
+            # Count the scanning done in the pool
+                for (name, amount) in result[2]:
+                    stats.Count(name, amount)
+    return scanned
+
+
+def ParseTask(filename, pack=None):
+    '''Pool task: parse a metadata file, logging any problems and
+       returning what was counted.
+    '''
+    before = dict(stats.counters)
+    log = []
+    info = ParseMeta(filename, log, pack)
+    return (PackInfo(info), log, CountedSince(before))
+
+
+def ParseFiles(filenames, signatures, cache=None, pool=None, jobs=1, debug=False,
+               pack=None):
+    '''Generate the (filename, metadata) of each file in turn, from the cache
+       where possible, parsing the rest in the pool if there is one (or from
+       the pack, if there is one, without the pool).
+       Problems are reported as if each file was parsed in turn.
+    '''
+    if pack is not None:
+        pool = None
+    if cache is not None:
+        for filename in filenames:
+            if signatures.get(filename, None) is None:
+                signatures[filename] = StatSignature(filename)
+    parsed = {}
+    if pool is not None:
+        todo = [filename for filename in filenames
+                if cache is None or cache.Get(filename, signatures[filename]) is None]
+        parsed = dict(zip(todo, PoolMap(ParseTask, todo, pool, jobs)))
+    for filename in filenames:
+        if debug:
+            sys.stderr.write(filename+'\n')
+        if cache is None and pool is None:
+            yield (filename, ParseMeta(filename, None, pack))
+            continue
+        entry = None
+        if cache is not None and filename not in parsed:
+            entry = cache.Get(filename, signatures[filename])
+        if entry is None:
+            if filename in parsed:
+            # Count the parsing done in the pool
+                (packed, log, counters) = parsed.pop(filename)
+                for (name, amount) in counters:
+                    stats.Count(name, amount)
+            else:
+                (packed, log, counters) = ParseTask(filename, pack)
+            if cache is not None:
+                cache.Store(filename, signatures[filename], packed, log)
+        else:
+            (packed, log) = entry
+            stats.Count('files_cached')
+        for (out, text, kind) in log:
+            Warn(text, None, out, kind)
+        yield (filename, UnpackInfo(packed))
+
+
+class DeltaNode(dict):
+    ''' Wraps dict class to hold the running sum & count of its leaf deltas.'''
+    def __init__(self):
+        dict.__init__(self)
+        self.sum   = timedelta(0)
+        self.count = 0
+
+
+def KeyPath(key):
+    '''Split a filename key into its path elements.'''
+# Get path elements and remove null root element
+    path = key.split('/')
+    if len(path[0]) == 0:
+        path.pop(0)
+    return path
+
+
+def AddDelta(tree, key, delta):
+    '''Add the date delta of a file to the tree, replacing any previous value.'''
+# Unwind the path to create the tree
+    path = KeyPath(key)
+    nodes = [tree]
+    leaf = path.pop()
+    for element in path:
+        node = nodes[-1]
+        if element not in node:
+            node[element] = DeltaNode()
+        nodes.append(node[element])
+# Now at the tip of the tree - replace any previous value
+    old = nodes[-1].get(leaf, None)
+    nodes[-1][leaf] = delta
+    for node in nodes:
+        if old is None:
+            node.count += 1
+        else:
+            node.sum -= old
+        node.sum += delta
+
+
+def AddSum(tree, path, delta):
+    '''Add a date delta to the sums & counts of the nodes along the path,
+       without keeping the delta itself.
+    '''
+    node = tree
+    node.sum += delta
+    node.count += 1
+    for element in path:
+        if element not in node:
+            node[element] = DeltaNode()
+        node = node[element]
+        node.sum += delta
+        node.count += 1
+
+
+def RemoveDelta(tree, key):
+    '''Remove the date delta of a file from the tree, pruning empty nodes.'''
+    path = KeyPath(key)
+    nodes = [tree]
+    leaf = path.pop()
+    for element in path:
+        if element not in nodes[-1]:
+            return
+        nodes.append(nodes[-1][element])
+    delta = nodes[-1].pop(leaf, None)
+    if delta is None:
+        return
+    for node in nodes:
+        node.count -= 1
+        node.sum -= delta
+    for depth in range(len(path), 0, -1):
+        if nodes[depth].count == 0:
+            del nodes[depth-1][path[depth-1]]
+
+
+def LeafDelta(info, source, target):
+    '''Return the date delta of the file metadata, if it has both dates.'''
+    if source in info and target in info:
+        return info[target] - info[source]
+    return None
+
+
 def InitDelta(source, target, meta):
-    '''Create a tree structure of all the date deltas from the file metadata.'''
-    tree = {}
+    '''Create a tree structure of all the date deltas from the file metadata.
+       Each node of the tree keeps the sum & count of the deltas below it.
+    '''
+    tree = DeltaNode()
     for key in meta:
-        info = meta[key]
-        if source in info and target in info:
-            delta = info[target] - info[source]
-        # Get path elements and remove null root element
-            path = key.split('/')
-            if len(path[0]) == 0:
-                path.pop(0)
-        # Unwind the path to create the tree
-            node = tree
-            leaf = path.pop()
-            for element in path:
-                if element not in node:
-                    node[element] = {}
-                node = node[element]
-        # Now at the tip of the tree
-            node[leaf] = delta
+        delta = LeafDelta(meta[key], source, target)
+        if delta is not None:
+            AddDelta(tree, key, delta)
     return tree
 
 
 def SumLeaves(tree):
-    '''Calculate the sum and count for all leaf values of the tree.'''
-    sum  = timedelta(0)
-    count = 0
-    for key in tree:
-        if isinstance(tree[key], dict):
-            (treesum, treecount) = SumLeaves(tree[key])
-            sum   += treesum
-            count += treecount
-        else:
-            sum   += tree[key]
-            count += 1
-    return (sum, count)
+    '''Return the sum and count for all leaf values of the tree.'''
+    return (tree.sum, tree.count)
 
 
-def Average(path, tree):
-    '''Calculate the average of the leaves at the deepest extent of the path
-       that has values to be averaged.
+def Deepest(path, tree):
+    '''Find the deepest extent of the path that has values to be averaged,
+       returning its depth (0 if there is none) and node.
     '''
-# Start backup up if we reach the tip of the tree
-# - by getting to the end of the path
-    if len(path) == 0:
-        return None
-# - or running out of tree
-    element = path.pop(0)
-    if element not in tree:
-        return None
-# Otherwise descend the tree
-    average = Average(path, tree[element])
-# And calc an average if necessary
-    if average is None:
-        (sum, count) = SumLeaves(tree[element])
+# Descend the tree as far as the path allows
+    nodes = []
+    for element in path:
+        if element not in tree:
+            break
+        tree = tree[element]
+        nodes.append(tree)
+# Then back up until there is an average to be had
+    for depth in range(len(nodes), 0, -1):
+        (sum, count) = SumLeaves(nodes[depth-1])
         if count > 0:
-        # - and possible
-            average = sum / count
-    return average
+            return (depth, nodes[depth-1])
+    return (0, None)
 
 
 def CalcDelta(key, tree):
     '''Estimate a date delta by comparing dates in the filename tree.'''
-# Get path elements and remove null root element
-    path = key.split('/')
-    if len(path[0]) == 0:
-        path.pop(0)
 # Start the averaging one level up
+    path = KeyPath(key)
     path.pop()
-    delta = Average(path, tree)
-    return delta
+    (depth, node) = Deepest(path, tree)
+    if node is None:
+        stats.Count('estimates_without_delta')
+        return None
+# Count how many levels up the tree the average came from
+    stats.Count('estimates_fallback_%d' % (len(path) - depth))
+    (sum, count) = SumLeaves(node)
+    return sum / count
 
 
-def Estimate(source, target, meta):
-    '''Estimate any missing target broadcast data.'''
-    global opts
-    tree = InitDelta(source, target, meta)
-    for key in meta:
-        info = meta[key]
-        if target not in info:
-            delta = CalcDelta(key, tree)
-            estimate = info.get(source, None)
-            if estimate is not None:
-                estimate += delta
-            info['TARGET'] = estimate
-            info['DELTA'] = delta
-        elif opts.override and info[target].isEstimate:
-            delta = CalcDelta(key, tree)
-            estimate = info.get(source, None)
-            if estimate is not None:
-                estimate += delta
-            info['TARGET'] = estimate
-            info['DELTA'] = delta
+def NeedsEstimate(info, target, override=False):
+    '''Is the target date of the file metadata missing (or approximate,
+       when overriding)?
+    '''
+    return target not in info or (override and info[target].isEstimate)
+
+
+def NoDelta(filename):
+    '''Return the error for a file with a source date but no delta along
+       its path to estimate from.
+    '''
+    return ValueError("No delta along the path of %s to estimate from" % filename)
+
+
+def CheckDeltas(tree, pending, source, target):
+    '''Raise ValueError if there are dates to estimate (from a source date)
+       but no deltas at all in the tree to estimate them from.
+    '''
+    if tree.count == 0 and any([ordinal for (filename, fileid, ordinal) in pending]):
+        raise ValueError("No delta to estimate %s from %s" % (target, source))
+
+
+def ApplyDelta(filename, info, source, delta):
+    '''Set the target date of the file metadata to its source date plus the
+       estimated delta, noting the delta used.
+    '''
+    estimate = info.get(source, None)
+    if estimate is not None:
+        if delta is None:
+            raise NoDelta(filename)
+        estimate += delta
+    info['TARGET'] = estimate
+    info['DELTA'] = delta
+
+
+def EstimateInfo(key, info, source, target, tree, override=False):
+    '''Set the target date of the file metadata, estimating it if missing
+       (or approximate, when overriding) and noting the delta used.
+    '''
+    if NeedsEstimate(info, target, override):
+        ApplyDelta(key, info, source, CalcDelta(key, tree))
+    else:
+        info['TARGET'] = info[target]
+    return info
+
+
+def SumTable(table, files, source, target, override=False):
+    '''Sum the deltas of the files (a dict of file ids by filename) up the
+       tree from the table's columns, returning the tree, the target date
+       ordinals by file id (0 if unknown) and the (filename, file id, source
+       date ordinal) of the files with missing (or approximate, when
+       overriding) dates to estimate.
+    '''
+    (sources, flags) = table.Column(source)
+    (targets, flags) = table.Column(target)
+# Sum the deltas up the tree, leaving out the files themselves
+    tree = DeltaNode()
+    for (filename, fileid) in files.iteritems():
+        if sources[fileid] and targets[fileid]:
+            AddSum(tree, KeyPath(filename)[:-1],
+                   timedelta(targets[fileid] - sources[fileid]))
+# Then find the dates to estimate
+    pending = []
+    for (filename, fileid) in files.iteritems():
+        if targets[fileid] and not (override and flags[fileid]):
+            continue
+        ordinal = sources[fileid]
+        if override and not targets[fileid]:
+            ordinal = 0
+        pending.append((filename, fileid, ordinal))
+    return (tree, targets, pending)
+
+
+def EstimateTable(table, files, source, target, override=False):
+    '''Estimate any missing target dates of the files (a dict of file ids by
+       filename) from the table's columns, returning the target date
+       ordinals by file id (0 if unknown) and the deltas used for the
+       estimated files, by file id.
+    '''
+    (tree, targets, pending) = SumTable(table, files, source, target, override)
+    CheckDeltas(tree, pending, source, target)
+    return (targets, EstimatePending(tree, targets, pending))
+
+
+def EstimatePending(tree, targets, pending):
+    '''Estimate the target dates of the pending files (as SumTable returns
+       them) from the tree into the target date ordinals, returning the
+       deltas used by file id.
+    '''
+    deltas = {}
+    for (filename, fileid, ordinal) in pending:
+        delta = CalcDelta(filename, tree)
+        if ordinal:
+            if delta is None:
+                raise NoDelta(filename)
+            ordinal = (date.fromordinal(ordinal) + delta).toordinal()
+        targets[fileid] = ordinal
+        deltas[fileid] = delta
+    return deltas
+
+
+# Episode ids in metadata file names: <series>.<season>x<episode>[.<title>][.Part.<part>]...
+EPISODE = re.compile(r'\.(\d+)x(\d+)\.')
+PART = re.compile(r'\.Part\.(\d+)\.')
+
+
+def EpisodeKey(filename):
+    '''Return the (season, episode, part) of a metadata file from its name,
+       or None if it has no episode id.
+    '''
+    name = os.path.basename(filename)
+    match = EPISODE.search(name)
+    if match is None:
+        return None
+    part = PART.search(name, match.end() - 1)
+    return (int(match.group(1)), int(match.group(2)), part and int(part.group(1)) or 0)
+
+
+def NearestDelta(keys, known, key, fileid, ordinal):
+    '''Interpolate a date delta (in days) from the known deltas of the
+       episodes either side of the episode key in a directory, by source
+       date where both sides have one, returning None if there are none.
+       The keys are sorted, with the known (key, file id, source date
+       ordinal, delta in days) in the same order.
+    '''
+    pos = bisect.bisect_left(keys, key)
+    (left, right) = (pos - 1, pos)
+# Leave out the file itself (an approximate date when overriding)
+    while right < len(keys) and known[right][1] == fileid:
+        right += 1
+    if left < 0 and right >= len(keys):
+        return None
+    if left < 0:
+        return known[right][3]
+    if right >= len(keys):
+        return known[left][3]
+    (before, after) = (known[left], known[right])
+    if not ordinal or after[2] == before[2]:
+        return (before[3] + after[3]) / 2.0
+    weight = min(max(float(ordinal - before[2]) / (after[2] - before[2]), 0.0), 1.0)
+    return before[3] + (after[3] - before[3]) * weight
+
+
+def EstimateNearest(table, files, source, target, override=False):
+    '''Estimate as EstimateTable does, but from the known deltas of the
+       nearest episodes either side in the same directory (found by
+       bisecting its episodes sorted by episode id), falling back to the
+       average up the tree for files without an episode id or neighbours.
+    '''
+    (tree, targets, pending) = SumTable(table, files, source, target, override)
+    CheckDeltas(tree, pending, source, target)
+    (sources, flags) = table.Column(source)
+# Index the known deltas of each directory by episode id
+    episodes = {}
+    for (filename, fileid) in files.iteritems():
+        if sources[fileid] and targets[fileid]:
+            key = EpisodeKey(filename)
+            if key is not None:
+                episodes.setdefault(filename.rsplit('/', 1)[0], []).append(
+                    (key, fileid, sources[fileid], targets[fileid] - sources[fileid]))
+    index = {}
+    for (dirpath, known) in episodes.iteritems():
+        known.sort()
+        index[dirpath] = ([entry[0] for entry in known], known)
+# Then estimate from the neighbours where there are any
+    deltas = {}
+    for (filename, fileid, ordinal) in pending:
+        delta = None
+        key = EpisodeKey(filename)
+        if key is not None and filename.rsplit('/', 1)[0] in index:
+            (keys, known) = index[filename.rsplit('/', 1)[0]]
+            days = NearestDelta(keys, known, key, fileid, sources[fileid])
+            if days is not None:
+                stats.Count('estimates_nearest')
+                delta = timedelta(days)
+        if delta is None:
+            delta = CalcDelta(filename, tree)
+        if ordinal:
+            if delta is None:
+                raise NoDelta(filename)
+            ordinal = (date.fromordinal(ordinal) + delta).toordinal()
+        targets[fileid] = ordinal
+        deltas[fileid] = delta
+    return (targets, deltas)
+
+
+def TreeSums(tree):
+    '''Return the (sum in days, count) of the deltas at each node of the
+       tree, by path prefix (a tuple).
+    '''
+    sums = {}
+    stack = [((), tree)]
+    while stack:
+        (prefix, node) = stack.pop()
+        sums[prefix] = (node.sum.days, node.count)
+        for (element, child) in node.iteritems():
+            if isinstance(child, DeltaNode):
+                stack.append((prefix + (element,), child))
+    return sums
+
+
+def MergeSums(tree, sums):
+    '''Add the sums & counts of the deltas by path prefix to the tree.'''
+    for (prefix, (days, count)) in sums.iteritems():
+        node = tree
+        for element in prefix:
+            if element not in node:
+                node[element] = DeltaNode()
+            node = node[element]
+        node.sum += timedelta(days)
+        node.count += count
+
+
+def ReducePartials(partials):
+    '''Merge the partial sums of shards (from Engine.Partial), generating
+       the (filename, info) of every file of every shard, with the missing
+       dates estimated from the sums of all the shards.
+    '''
+    tree = DeltaNode()
+    for partial in partials:
+        if partial['config'] != partials[0]['config']:
+            raise ValueError("Shards made with other options: %s != %s" %
+                             (partial['config'], partials[0]['config']))
+        MergeSums(tree, partial['sums'])
+    for partial in partials:
+        for (filename, ordinal) in partial['known']:
+            yield (filename, TableInfo(0, [ordinal], {}))
+        for (filename, ordinal) in partial['pending']:
+            delta = CalcDelta(filename, tree)
+            if ordinal:
+                if delta is None:
+                    raise NoDelta(filename)
+                ordinal = (date.fromordinal(ordinal) + delta).toordinal()
+            yield (filename, TableInfo(0, [ordinal], {0: delta}))
+
+
+def ReadPartials(filenames):
+    '''Return the partial sums of the shard files (from Engine.Map),
+       raising ValueError if any cannot be read.
+    '''
+    partials = []
+    for filename in filenames:
+        try:
+            file = open(filename, 'rb')
+            try:
+                partial = cPickle.load(file)
+            finally:
+                file.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), error:
+            raise ValueError("Cannot read shard %s: %s" % (filename, error))
+        if not isinstance(partial, dict) or partial.get('version', None) != PARTIAL_VERSION:
+            raise ValueError("Not a shard file: %s" % filename)
+        partials.append(partial)
+    return partials
+
+
+def NumpyColumn(table, tag):
+    '''Return the date ordinals (0 if missing) & estimate flags of the tag,
+       by file id, as NumPy arrays.
+    '''
+    ordinals = numpy.zeros(len(table.filenames), numpy.int64)
+    flags = numpy.zeros(len(table.filenames), numpy.bool_)
+    tagid = table.tagids.get(tag, None)
+    if tagid is None:
+        return (ordinals, flags)
+# Find the cells of the tag and the files they belong to
+    starts = numpy.frombuffer(table.starts, table.starts.typecode)
+    cells = numpy.frombuffer(table.tags, table.tags.typecode) == tagid
+    fileids = numpy.repeat(numpy.arange(len(table.filenames)), numpy.diff(starts))
+    ordinals[fileids[cells]] = numpy.frombuffer(table.ordinals,
+                                                table.ordinals.typecode)[cells]
+    flags[fileids[cells]] = numpy.frombuffer(table.flags, table.flags.typecode)[cells]
+    return (ordinals, flags)
+
+
+def EstimateNumpy(table, files, source, target, override=False):
+    '''Estimate as EstimateTable does, using NumPy: each path prefix of
+       each level is a group, the deltas of all groups are summed at once,
+       then each missing date is estimated from the deepest group along
+       its path that has any deltas.
+    '''
+    (sources, flags) = NumpyColumn(table, source)
+    (targets, flags) = NumpyColumn(table, target)
+    result = array('l', targets.tolist())
+    deltas = {}
+    if not files:
+        return (result, deltas)
+# Number the directories, and the groups along the path of each
+    fileids = files.values()
+    dirids = {}
+    fileof = numpy.array([dirids.setdefault(filename[:filename.rfind('/')+1],
+                                            len(dirids))
+                          for filename in files], numpy.int64)
+    groups = {}
+    paths = [None] * len(dirids)
+    for (dirname, dirid) in dirids.iteritems():
+        path = KeyPath(dirname + '-')[:-1]
+        paths[dirid] = [groups.setdefault(tuple(path[:depth]), len(groups))
+                        for depth in range(1, len(path)+1)]
+    depths = numpy.array([len(prefixes) for prefixes in paths], numpy.int64)
+    grid = numpy.full((len(paths), max(1, depths.max())), -1, numpy.int64)
+    for (dirid, path) in enumerate(paths):
+        grid[dirid, :len(path)] = path
+# Sum & count the deltas of each directory, then of each group
+    ids = numpy.array(fileids, numpy.int64)
+    (sources, targets, flags) = (sources[ids], targets[ids], flags[ids])
+    known = (sources > 0) & (targets > 0)
+    dirsums = numpy.zeros(len(paths), numpy.int64)
+    numpy.add.at(dirsums, fileof[known], (targets - sources)[known])
+    dircounts = numpy.bincount(fileof[known], minlength=len(paths))
+    sums = numpy.zeros(len(groups), numpy.int64)
+    counts = numpy.zeros(len(groups), numpy.int64)
+    for level in range(grid.shape[1]):
+        column = grid[:, level]
+        valid = column >= 0
+        numpy.add.at(sums, column[valid], dirsums[valid])
+        numpy.add.at(counts, column[valid], dircounts[valid])
+# Find the deepest group with deltas for each missing (or approximate,
+# when overriding) date
+    if override:
+        rows = numpy.nonzero((targets == 0) | flags)[0]
+    else:
+        rows = numpy.nonzero(targets == 0)[0]
+    best = numpy.full(len(rows), -1, numpy.int64)
+    found = numpy.zeros(len(rows), numpy.int64)
+    rowgrid = grid[fileof[rows]]
+    for level in range(grid.shape[1]):
+        column = rowgrid[:, level]
+        mask = (column >= 0) & (counts[numpy.maximum(column, 0)] > 0)
+        best[mask] = column[mask]
+        found[mask] = level + 1
+    missing = best < 0
+    if numpy.any(missing):
+        stats.Count('estimates_without_delta', int(missing.sum()))
+    fallbacks = numpy.bincount((depths[fileof[rows]] - found)[~missing])
+    for (fallback, count) in enumerate(fallbacks.tolist()):
+        if count:
+            stats.Count('estimates_fallback_%d' % fallback, count)
+# Then add the group's average delta to the source date
+    bases = sources[rows]
+    if override:
+        bases[targets[rows] == 0] = 0
+    if numpy.any((bases > 0) & missing):
+        raise ValueError("No delta to estimate %s from %s" % (target, source))
+    groupids = numpy.maximum(best, 0)
+    estimates = numpy.where(bases > 0, bases + numpy.floor_divide(
+        sums[groupids], numpy.maximum(counts[groupids], 1)), 0)
+    averages = {}
+    for (row, group, ordinal) in zip(rows.tolist(), best.tolist(),
+                                     estimates.tolist()):
+        delta = None
+        if group >= 0:
+            delta = averages.get(group, None)
+            if delta is None:
+                delta = timedelta(int(sums[group])) / int(counts[group])
+                averages[group] = delta
+        result[fileids[row]] = ordinal
+        deltas[fileids[row]] = delta
+    return (result, deltas)
+
+
+def TableInfo(fileid, targets, deltas):
+    '''Return the target date of a file from EstimateTable (and the delta
+       used, if estimated) as file metadata for output.
+    '''
+    info = {'TARGET': None}
+    if targets[fileid]:
+        info['TARGET'] = date.fromordinal(targets[fileid])
+    if fileid in deltas:
+        info['DELTA'] = deltas[fileid]
+    return info
+
+
+def InfoLine(filename, info, debug=False, label=None):
+    '''Return the output line for the target date of a file (and the delta
+       used, if debugging), labelled if there is a label.
+    '''
+    if label is not None:
+        filename = label + ':' + filename
+    if debug != True:
+        return "%s:%s" % (filename, info['TARGET'])
+    return "%s:%s %s" % (filename, info['TARGET'], info.get('DELTA', None))
+
+
+def StreamDir(dirpath, metadate, wantstat):
+    '''Generate the (path elements, filename, signature) of each metadata
+       file in the hierarchy in path order, listing one directory at a time.
+    '''
+    (files, dirs) = ListDir(dirpath, wantstat or bool(metadate))
+    index = RevisionIndex(dirpath, files, bool(metadate))
+    items = [(KeyPath(filename), filename, signature, False)
+             for (filename, signature) in SelectRevisions(index, metadate)]
+    items.extend([(KeyPath(subdir), subdir, None, True) for subdir in dirs])
+    items.sort()
+    for (path, name, signature, isdir) in items:
+        if isdir:
+            for item in StreamDir(name, metadate, wantstat):
+                yield item
+        else:
+            yield (path, name, signature)
+
+
+def StreamFiles(paths, metadate, wantstat):
+    '''Generate the (path elements, filename, signature) of each metadata
+       file in the paths, merged into path order.
+    '''
+    streams = []
+    for path in paths:
+        if os.path.isdir(path):
+            streams.append(StreamDir(path, metadate, wantstat))
         else:
+            streams.append(iter([(KeyPath(path), path, None)]))
+    return heapq.merge(*streams)
+
+
+def CloseFrames(frames, depth, source, writer):
+    '''Finish the open directories deeper than depth, outputting the files
+       waiting on the first directory up with deltas to average.
+    '''
+    while len(frames) > depth:
+        (element, sum, count, pending) = frames.pop()
+        if count > 0:
+            delta = sum / count
+        elif frames:
+        # Nothing to average yet - leave it to the parent directory
+            frames[-1][3].extend(pending)
+            continue
+        else:
+            delta = None
+        for (filename, info, filedepth) in pending:
+            if delta is None:
+                stats.Count('estimates_without_delta')
+            else:
+                stats.Count('estimates_fallback_%d' % (filedepth - len(frames) - 1))
+            ApplyDelta(filename, info, source, delta)
+            writer.Write(filename, [info])
+        if frames:
+            frames[-1][1] += sum
+            frames[-1][2] += count
+
+
+def Stream(paths, source, target, metadate=None, override=False, cache=None,
+           debug=False, writer=None):
+    '''Output the target date of each metadata file in path order, keeping
+       only the delta sums & counts of the directories open along the path.
+       Known dates are output at once, and estimates as soon as the
+       directory they are averaged over is complete.
+    '''
+    if writer is None:
+        writer = Writer([(source, target)], debug=debug)
+    frames = []
+    previous = None
+    for (path, filename, signature) in StreamFiles(paths, metadate,
+                                                   cache is not None):
+        if filename == previous:
+            continue
+        previous = filename
+    # Finish the directories no longer on the path & open the new ones
+        dirs = path[:-1]
+        depth = 0
+        while (depth < len(frames) and depth < len(dirs) and
+               frames[depth][0] == dirs[depth]):
+            depth += 1
+        CloseFrames(frames, depth, source, writer)
+        for element in dirs[depth:]:
+            frames.append([element, timedelta(0), 0, []])
+    # Now deal with the file itself (after the output so far, as any problems
+    # with it may be output too)
+        if writer.pending:
+            writer.Flush()
+        for (filename, info) in ParseFiles([filename], {filename: signature},
+                                           cache, debug=debug):
+            pass
+        if override and target not in info:
+            info = {}
+        delta = LeafDelta(info, source, target)
+        if delta is not None and frames:
+            frames[-1][1] += delta
+            frames[-1][2] += 1
+        if not NeedsEstimate(info, target, override):
             info['TARGET'] = info[target]
-    return meta
+            writer.Write(filename, [info])
+        elif frames:
+            frames[-1][3].append((filename, info, len(frames)))
+        else:
+            stats.Count('estimates_without_delta')
+            ApplyDelta(filename, info, source, None)
+            writer.Write(filename, [info])
+    CloseFrames(frames, 0, source, writer)
+    writer.Flush()
+
+
+def ColumnsLine(filename, infos, debug=False, label=None):
+    '''Return the output line for the target dates of a file for each source
+       & target pair (and the deltas used, if debugging), labelled if there
+       is a label.
+    '''
+    if label is not None:
+        filename = label + ':' + filename
+    line = ':'.join([filename] + [str(info['TARGET']) for info in infos])
+    if debug == True:
+        line += ' ' + ' '.join([str(info.get('DELTA', None)) for info in infos])
+    return line
+
+
+class Writer(object):
+    ''' Buffered output of the target dates of files (one info per source &
+        target pair), as text lines (see InfoLine & ColumnsLine),
+        or as JSON lines, CSV or TSV with a named column per date & delta.
+        Files are output sorted by date or path at each Flush if wanted,
+        otherwise whenever enough lines are waiting.
+    '''
+    FORMATS = ('text', 'jsonl', 'csv', 'tsv')
+    ORDERS = ('date', 'path')
+    LINES = 4096
+
+    def __init__(self, pairs, format='text', order=None, basename=False,
+                 debug=False, labelled=False, out=None):
+        self.format = format
+        self.order = order
+        self.basename = basename
+        self.debug = debug
+        self.out = out or sys.stdout
+        self.pending = []
+        self.columns = ['file']
+        if labelled:
+            self.columns.append('metadate')
+        names = ['date']
+        if len(pairs) > 1:
+            names = ['%s:%s' % pair for pair in pairs]
+        self.columns.extend(names)
+        if debug == True:
+            self.columns.extend([name == 'date' and 'delta' or name + ':delta'
+                                 for name in names])
+        self.header = format in ('csv', 'tsv')
+
+    def Write(self, filename, infos, label=None):
+        '''Output (in time) the target dates of a file.'''
+        if self.basename:
+            filename = os.path.basename(filename)
+            if filename.startswith('.'):
+                filename = filename[1:]
+        self.pending.append((filename, infos, label))
+        if self.order is None and len(self.pending) >= self.LINES:
+            self.Flush()
+
+    def Values(self, filename, infos, label):
+        '''Return the column values of a file, dates as ISO strings & deltas
+           as days.
+        '''
+        values = [filename]
+        if 'metadate' in self.columns:
+            values.append(label)
+        values.extend([info['TARGET'] and info['TARGET'].isoformat()
+                       for info in infos])
+        if self.debug == True:
+            for info in infos:
+                delta = info.get('DELTA', None)
+                if delta is not None:
+                    delta = delta.total_seconds() / 86400
+                values.append(delta)
+        return values
+
+    def Flush(self):
+        '''Output the waiting files, sorted if wanted.'''
+        pending = self.pending
+        self.pending = []
+        if self.order == 'date':
+        # Files without a date (None) go last
+            pending.sort(key=lambda (filename, infos, label):
+                         ([(info['TARGET'] is None, info['TARGET']) for info in infos],
+                          filename))
+        elif self.order == 'path':
+            pending.sort(key=lambda (filename, infos, label): filename)
+        if self.format == 'text':
+            lines = [len(infos) == 1 and InfoLine(filename, infos[0], self.debug, label)
+                     or ColumnsLine(filename, infos, self.debug, label)
+                     for (filename, infos, label) in pending]
+            self.out.write(''.join([line + '\n' for line in lines]))
+        elif self.format == 'jsonl':
+        # Encode each value (not each object), as the keys never change
+            keys = [json.dumps(column) + ': ' for column in self.columns]
+            encode = json.dumps
+            self.out.write(''.join([
+                '{' + ', '.join([key + (value is None and 'null' or encode(value))
+                                 for (key, value) in zip(keys, self.Values(*entry))])
+                + '}\n' for entry in pending]))
+        else:
+            buffer = StringIO.StringIO()
+            output = csv.writer(buffer, delimiter=self.format == 'tsv' and '\t' or ',',
+                                lineterminator='\n')
+            if self.header:
+                output.writerow(self.columns)
+                self.header = False
+            output.writerows([self.Values(*entry) for entry in pending])
+            self.out.write(buffer.getvalue())
+
+
+def MetaDate(value):
+    '''Return the datetime (at midnight) of a metadate given as a date or
+       string, or False if there is none.
+    '''
+    if not value:
+        return False
+    if isinstance(value, basestring):
+        value = ParseDate(value)
+        if not value:
+            return value
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.min.time())
+    return value
+
+
+def SortedPaths(keys):
+    '''Return the sorted (absolute path, key) pairs of filename keys.'''
+    return sorted([(os.path.abspath(key), key) for key in keys])
+
+
+def PathRange(paths, path):
+    '''Return the (start, end) positions of a file, or of the files under a
+       directory, in sorted (absolute path, key) pairs.
+    '''
+    path = os.path.abspath(path)
+    pos = bisect.bisect_left(paths, (path,))
+    if pos < len(paths) and paths[pos][0] == path:
+        return (pos, pos + 1)
+    prefix = path.rstrip('/') + '/'
+# Everything under the directory sorts before its path followed by '0'
+    return (bisect.bisect_left(paths, (prefix,), pos),
+            bisect.bisect_left(paths, (prefix[:-1] + '0',), pos))
+
+
+def PathKeys(paths, path):
+    '''Return the key of a file, or the keys of the files under a directory,
+       from sorted (absolute path, key) pairs.
+    '''
+    (start, end) = PathRange(paths, path)
+    return [paths[pos][1] for pos in xrange(start, end)]
+
+
+class DateIndex(object):
+    ''' Persistent index of the files by date for each tag: the date
+        ordinals & file ids of each tag sorted by date, the file ids being
+        positions in the sorted (absolute path, filename) pairs.
+        The target tag holds the target dates as output (estimated where
+        need be), the other tags the dates as parsed.
+    '''
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.config = None
+        self.tops = []
+        self.paths = []
+        self.tags = {}
+        try:
+            file = open(filename, 'rb')
+            try:
+                store = cPickle.load(file)
+            finally:
+                file.close()
+            if store.get('version', None) == self.VERSION:
+                self.config = store['config']
+                self.tops = store['tops']
+                self.paths = store['paths']
+                for (tag, (ordinals, fileids)) in store['tags'].iteritems():
+                    self.tags[tag] = (array('l', ordinals), array('l', fileids))
+        except Exception:
+        # Missing or unreadable index - needs building
+            pass
+
+    def Build(self, table, files, targets, target, config, tops):
+        '''Index the files (a dict of file ids by filename) of the table,
+           with their target date ordinals (by file id, 0 if unknown),
+           found under the top (absolute) paths.
+        '''
+        self.config = config
+        self.tops = tops
+        self.paths = SortedPaths(files)
+        entries = {}
+        for (position, (abspath, filename)) in enumerate(self.paths):
+            fileid = files[filename]
+            for cell in xrange(table.starts[fileid], table.starts[fileid+1]):
+                tag = table.tagnames[table.tags[cell]]
+                if tag != target:
+                    entries.setdefault(tag, []).append((table.ordinals[cell], position))
+            if targets[fileid]:
+                entries.setdefault(target, []).append((targets[fileid], position))
+        self.tags = {}
+        for (tag, cells) in entries.iteritems():
+            cells.sort()
+            self.tags[tag] = (array('l', [ordinal for (ordinal, position) in cells]),
+                              array('l', [position for (ordinal, position) in cells]))
+
+    def Save(self):
+        '''Write the index.'''
+        tmpname = self.filename + '.tmp'
+        file = open(tmpname, 'wb')
+        try:
+            cPickle.dump({'version': self.VERSION, 'config': self.config,
+                          'tops': self.tops, 'paths': self.paths,
+                          'tags': dict([(tag, (ordinals.tostring(), fileids.tostring()))
+                                        for (tag, (ordinals, fileids))
+                                        in self.tags.iteritems()])},
+                         file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+        os.rename(tmpname, self.filename)
+
+    def Between(self, tag, first=None, last=None):
+        '''Return the (filename, date) of the files with a date for the tag
+           between the first & last dates (inclusive, if given), by date.
+        '''
+        (ordinals, fileids) = self.tags.get(tag, (array('l'), array('l')))
+        start = 0
+        end = len(ordinals)
+        if first is not None:
+            start = bisect.bisect_left(ordinals, first.toordinal())
+        if last is not None:
+            end = bisect.bisect_right(ordinals, last.toordinal())
+        return [(self.paths[fileids[pos]][1], date.fromordinal(ordinals[pos]))
+                for pos in xrange(start, end)]
+
+    def Covers(self, paths):
+        '''Return whether all the paths were indexed.'''
+        for path in paths:
+            path = os.path.abspath(path)
+            if not [top for top in self.tops
+                    if path == top or path.startswith(top.rstrip('/') + '/')]:
+                return False
+        return True
+
+    def Under(self, paths):
+        '''Return the set of filenames under the paths.'''
+        return set([self.paths[pos][1] for path in paths
+                    for pos in xrange(*PathRange(self.paths, path))])
+
+    def Select(self, paths, tag, between=None, has_tag=None):
+        '''Return the (filename, date) of the files under the paths with a
+           date for the tag between the (first, last) dates, by date, or
+           only those with a date for has_tag too (or by that date alone,
+           if no dates between).
+        '''
+        if between:
+            found = self.Between(tag, *between)
+            if has_tag:
+                tagged = set([filename for (filename, value)
+                              in self.Between(has_tag)])
+                found = [(filename, value) for (filename, value) in found
+                         if filename in tagged]
+        else:
+            found = self.Between(has_tag)
+        under = self.Under(paths)
+        return [(filename, value) for (filename, value) in found
+                if filename in under]
+
+
+# Format of the partial sums of a shard
+PARTIAL_VERSION = 1
+
+
+class Engine(object):
+    ''' Estimates the target dates of metadata files, keeping the scanned,
+        parsed & estimated state for any number of queries in process.
+        Sources, targets & metadates may each be a list, estimating every
+        source & target pair (skipping matching pairs) as at every metadate.
+        Missing dates are estimated from the average delta up the tree, or
+        from the nearest episodes in the same directory if wanted.
+        The directories & files may be read from a pack file instead.
+        Errors are raised as ValueError, never exiting.
+    '''
+    def __init__(self, source='broadcast', target='AU', override=False,
+                 metadate=None, engine=None, cache=None, jobs=1, debug=False,
+                 pack=None, nearest=False):
+        if isinstance(source, basestring):
+            source = [source]
+        if isinstance(target, basestring):
+            target = [target]
+        self.pairs = [(s, t) for s in source for t in target]
+        if len(self.pairs) > 1:
+            self.pairs = [(s, t) for (s, t) in self.pairs if s != t]
+        if not isinstance(metadate, (list, tuple)):
+            metadate = [metadate]
+        self.metadates = [MetaDate(value) for value in metadate]
+        self.override = override
+        if nearest and engine == 'numpy':
+            raise ValueError("Cannot estimate from the nearest episodes with the numpy engine!")
+        if engine is None:
+            engine = numpy is not None and not nearest and 'numpy' or 'python'
+        if engine == 'numpy' and numpy is None:
+            raise ValueError("The numpy engine needs NumPy installed!")
+        if engine not in ('numpy', 'python'):
+            raise ValueError("Unknown engine: %s" % engine)
+        self.engine = engine
+        self.estimator = engine == 'numpy' and EstimateNumpy or EstimateTable
+        self.nearest = nearest
+        if nearest:
+            self.estimator = EstimateNearest
+        self.cache = cache
+        if isinstance(cache, basestring):
+            self.cache = MetaCache(cache)
+        self.jobs = jobs
+        self.debug = debug
+        self.packname = pack
+        self.pack = None
+        self.pool = None
+        self.scanned = None
+        self.tops = []
+        self.signatures = {}
+        self.runs = []
+        self.filenames = []
+        self.table = None
+        self.estimates = None
+        self.paths = None
+
+    def Pool(self):
+        '''Return the process pool, started when first needed.'''
+        if self.pool is None and self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs)
+        return self.pool
+
+    def Close(self):
+        '''Stop any process pool.'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def Repack(self, paths):
+        '''Write the pack file of the directory paths, reading only the
+           metadata files changed since it was last written.
+        '''
+        if self.pack is not None:
+            self.pack.Close()
+            self.pack = None
+        WritePack(self.packname, [path for path in paths if os.path.isdir(path)],
+                  self.Pool(), self.jobs)
+
+    def Scan(self, paths, keep=False):
+        '''Find the metadata files of the paths as at each metadate,
+           keeping the scanned directories if need be (to watch for changes).
+        '''
+        tops = [path for path in paths if os.path.isdir(path)]
+        self.tops = [os.path.abspath(path) for path in paths]
+        if self.packname:
+            if self.pack is None:
+                try:
+                    self.pack = Pack(self.packname)
+                except (IOError, EnvironmentError, EOFError, cPickle.UnpicklingError), error:
+                    raise ValueError("Cannot read pack %s: %s" % (self.packname, error))
+            self.scanned = self.pack.Scanned(tops, any(self.metadates))
+        else:
+            self.scanned = ScanTree(tops, bool(self.cache or keep),
+                                    any(self.metadates), self.Pool(), self.jobs)
+        self.runs = []
+        self.filenames = []
+        seen = set()
+        for metadate in self.metadates:
+            files = {}
+            selections = WalkOrder(tops, self.scanned, metadate)
+            for path in paths:
+                if not os.path.isdir(path):
+                    files[path] = None
+                else:
+                    for (filename, signature) in selections.pop(0):
+                        files[filename] = None
+                        if signature is not None:
+                            self.signatures[filename] = signature
+            self.filenames.extend([filename for filename in files
+                                   if filename not in seen])
+            seen.update(files)
+            self.runs.append(files)
+        if not keep:
+            self.scanned.clear()
+        self.table = self.estimates = self.paths = None
+        return self.filenames
+
+    def Parse(self):
+        '''Parse the metadata files found into the table.'''
+        self.table = MetaTable()
+        pool = None
+        if self.pack is None:
+            pool = self.Pool()
+        for (filename, info) in ParseFiles(self.filenames, self.signatures,
+                                           self.cache, pool, self.jobs,
+                                           self.debug, self.pack):
+            self.table.Add(filename, info)
+        if self.cache is not None:
+            self.cache.Save()
+        for files in self.runs:
+            for filename in files:
+                files[filename] = self.table.ids[filename]
+        self.estimates = None
+        return self.table
+
+    def Estimate(self, run=None):
+        '''Estimate the target dates for every source & target pair as at
+           each metadate (or only the numbered run of them).
+        '''
+        if self.estimates is None:
+            self.estimates = [None] * len(self.runs)
+        for number in range(len(self.runs)):
+            if run is None or number == run:
+                self.estimates[number] = [
+                    self.estimator(self.table, self.runs[number], source,
+                                   target, self.override)
+                    for (source, target) in self.pairs]
+
+    def Load(self, paths):
+        '''Scan, parse & estimate the paths.'''
+        self.Scan(paths)
+        self.Parse()
+        self.Close()
+        self.Estimate()
+
+    def Infos(self, fileid, run=0):
+        '''Return the info of a file for each source & target pair.'''
+        if self.estimates is None or self.estimates[run] is None:
+            self.Estimate(run)
+        return [TableInfo(fileid, *estimate) for estimate in self.estimates[run]]
+
+    def Results(self, run=0):
+        '''Generate the filename & infos (one per source & target pair)
+           of every file as at the numbered metadate.
+        '''
+        for (filename, fileid) in self.runs[run].iteritems():
+            yield (filename, self.Infos(fileid, run))
+
+    def Query(self, path, run=0):
+        '''Return the filename & infos of a file, or of every file under a
+           directory, as at the numbered metadate.
+        '''
+        if self.paths is None:
+            self.paths = SortedPaths(self.filenames)
+        files = self.runs[run]
+        return [(key, self.Infos(files[key], run))
+                for key in PathKeys(self.paths, path) if key in files]
+
+    def Index(self, filename):
+        '''Write the date index of the files to the file, for the first
+           metadate and source & target pair, returning the index.
+        '''
+        if self.estimates is None or self.estimates[0] is None:
+            self.Estimate(0)
+        index = DateIndex(filename)
+        index.Build(self.table, self.runs[0], self.estimates[0][0][0],
+                    self.pairs[0][1], self.Config(), self.tops)
+        index.Save()
+        return index
+
+    def Partial(self):
+        '''Return the partial sums & counts of the deltas at each path
+           prefix, the known target date ordinals and the files left to
+           estimate, for the first metadate and source & target pair, to
+           be merged with those of other shards by ReducePartials.
+        '''
+        (source, target) = self.pairs[0]
+        files = self.runs[0]
+        (tree, targets, pending) = SumTable(self.table, files, source, target,
+                                            self.override)
+        waiting = set([fileid for (filename, fileid, ordinal) in pending])
+        return {'version': PARTIAL_VERSION, 'config': self.Config(),
+                'sums': TreeSums(tree),
+                'known': [(filename, targets[fileid])
+                          for (filename, fileid) in files.iteritems()
+                          if fileid not in waiting],
+                'pending': [(filename, ordinal)
+                            for (filename, fileid, ordinal) in pending]}
+
+    def Config(self):
+        '''Return what the estimates depend on, for the first metadate and
+           source & target pair.
+        '''
+        metadate = self.metadates[0]
+        return (self.pairs[0], metadate and metadate.isoformat(), self.override,
+                self.nearest)
+
+    def Meta(self):
+        '''Return the metadata & estimate of each file, for the first
+           metadate and source & target pair, as a dict by filename.
+        '''
+        (source, target) = self.pairs[0]
+        meta = {}
+        for (filename, fileid) in self.runs[0].iteritems():
+            info = self.table.Info(fileid)
+            if self.override and target not in info:
+                info = {}
+            info.update(self.Infos(fileid)[0])
+            meta[filename] = info
+        return meta
+
+    def Indexed(self, filename, paths):
+        '''Return the date index in the file, (re)built first from the paths
+           if missing or made with other options or paths.
+        '''
+        self.CheckOne('querying')
+        index = DateIndex(filename)
+        if index.config != self.Config() or not index.Covers(paths):
+            self.Scan(paths)
+            self.Parse()
+            self.Close()
+            index = self.Index(filename)
+        return index
+
+    def Map(self, filename):
+        '''Write the partial sums of the paths scanned & parsed (a shard)
+           to the file, for ReducePartials.
+        '''
+        self.CheckOne('mapping')
+        tmpname = filename + '.tmp'
+        file = open(tmpname, 'wb')
+        try:
+            cPickle.dump(self.Partial(), file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+        os.rename(tmpname, filename)
+
+    def CheckOne(self, doing):
+        '''Raise ValueError unless there is a single metadate and source &
+           target pair (as needed when doing whatever).
+        '''
+        if len(self.metadates) > 1 or len(self.pairs) > 1:
+            raise ValueError("Only one metadate and source & target allowed when %s!" % doing)
+
+    def CheckSingle(self):
+        '''Raise ValueError unless estimating a single source & target pair
+           as at a single metadate, by the average delta of the directories
+           listed (as streaming & watching do).
+        '''
+        if len(self.metadates) > 1:
+            raise ValueError("Only one metadate allowed when streaming, watching or serving!")
+        if len(self.pairs) > 1:
+            raise ValueError("Only one source & target allowed when streaming, watching or serving!")
+        if self.nearest:
+            raise ValueError("Cannot estimate from the nearest episodes when streaming, watching or serving!")
+        if self.packname:
+            raise ValueError("Cannot stream, watch or serve from a pack file!")
+
+    def Stream(self, paths, writer=None):
+        '''Output the target date of each metadata file of the paths in path
+           order, with bounded memory (see Stream), instead of scanning.
+        '''
+        self.CheckSingle()
+        (source, target) = self.pairs[0]
+        Stream(paths, source, target, self.metadates[0], self.override,
+               self.cache, self.debug, writer)
+        if self.cache is not None:
+            self.cache.Save()
+
+    def Watch(self, paths, interval=5, serve=None, output=True, writer=None,
+              report=None):
+        '''Keep watching the paths (scanned keeping the directories) for
+           changes until interrupted, outputting the changed dates if wanted
+           & answering queries on the Unix socket serve (if any), calling
+           report (if any) after each update.  Only the metadata & delta
+           tree are kept up to date, the table & estimates are dropped.
+        '''
+        self.CheckSingle()
+        (source, target) = self.pairs[0]
+        meta = self.Meta()
+        tree = InitDelta(source, target, meta)
+        self.runs = []
+        self.table = self.estimates = self.paths = None
+        index = server = None
+        if serve:
+            index = QueryIndex(meta, self.debug)
+            server = Serve(serve, index)
+        try:
+            Watch(paths, self.scanned, meta, self.signatures, tree, source,
+                  target, self.metadates[0], self.override, interval,
+                  self.cache, index, writer, output, self.debug, report)
+        finally:
+            if server is not None:
+                server.server_close()
+                os.remove(serve)
+
+
+class PollWatcher(object):
+    ''' Waits between full rescans of the metadata hierarchies.'''
+    def __init__(self, tops, interval):
+        self.interval = interval
+
+    def Wait(self):
+        '''Wait for the next rescan, returning None to rescan everything.'''
+        time.sleep(self.interval)
+        return None
+
+
+class NotifyWatcher(object):
+    ''' Waits for inotify events in the metadata hierarchies (via pyinotify).'''
+    def __init__(self, tops, interval):
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.Event,
+                                           timeout=int(interval*1000))
+        mask = (pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        for top in tops:
+            self.manager.add_watch(top, mask, rec=True, auto_add=True)
+
+    def Event(self, event):
+        '''Note the directory holding whatever changed.'''
+        self.changed.add(event.path)
+
+    def Wait(self):
+        '''Wait for some changes, returning the directories to rescan.'''
+        while not self.changed:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                self.notifier.process_events()
+        (changed, self.changed) = (self.changed, set())
+        return changed
+
+
+def Rescan(scanned, dirpaths, wantdates):
+    '''Rescan the directories, scanning or dropping any subdirectories
+       that have come or gone since.
+    '''
+    for dirpath in sorted(dirpaths):
+        if dirpath not in scanned:
+            continue
+        old = scanned[dirpath][1]
+        scanned[dirpath] = ScanDir((dirpath, True, wantdates))[:2]
+        new = scanned[dirpath][1]
+        for subdir in old:
+            if subdir not in new:
+                for name in scanned.keys():
+                    if name == subdir or name.startswith(subdir + os.sep):
+                        del scanned[name]
+        ScanTree([subdir for subdir in new if subdir not in scanned],
+                 True, wantdates, scanned=scanned)
+
+
+class QueryIndex(object):
+    ''' Answers queries of the estimated dates of a file, or of all the files
+        under a directory, from the metadata kept up to date when watching.
+        The sorted paths are rebuilt only after files come or go.
+    '''
+    def __init__(self, meta, debug=False):
+        self.meta = meta
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.paths = None
+
+    def Changed(self):
+        '''Note files have come or gone, so the paths need rebuilding.'''
+        self.paths = None
+
+    def Query(self, path):
+        '''Return the output lines for a file, or the files under a directory.'''
+        self.lock.acquire()
+        try:
+            if self.paths is None:
+                self.paths = SortedPaths(self.meta)
+            return [InfoLine(key, self.meta[key], self.debug)
+                    for key in PathKeys(self.paths, path)
+                    if 'TARGET' in self.meta[key]]
+        finally:
+            self.lock.release()
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    ''' Answers each path read from a connection with its output lines,
+        followed by an empty line.
+    '''
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            lines = self.server.index.Query(line.rstrip('\r\n'))
+            self.wfile.write(''.join([text + '\n' for text in lines]) + '\n')
+            self.wfile.flush()
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    ''' Serves each connection in its own thread, from the query index.'''
+    daemon_threads = True
+
+    def __init__(self, path, index):
+        SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+        self.index = index
+
+
+def Serve(path, index):
+    '''Start answering queries on a Unix socket in the background,
+       replacing any stale socket, and return the server.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    server = QueryServer(path, index)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def Watch(paths, scanned, meta, signatures, tree, source, target, metadate=None,
+          override=False, interval=5, cache=None, index=None, writer=None,
+          output=True, debug=False, report=None):
+    '''Keep watching the metadata files for changes, updating the delta tree
+       and re-estimating only the files whose average delta may have moved.
+       Only the files with a changed target date are output (if wanted),
+       and report (if any) is called after each update.
+       Queries of any index are kept out while updating.
+    '''
+    if writer is None:
+        writer = Writer([(source, target)], debug=debug)
+    lock = threading.Lock()
+    if index is not None:
+        lock = index.lock
+    tops = [path for path in paths if os.path.isdir(path)]
+    if pyinotify is not None:
+        watcher = NotifyWatcher(tops, interval)
+    else:
+        watcher = PollWatcher(tops, interval)
+    for filename in meta:
+        if signatures.get(filename, None) is None:
+            try:
+                signatures[filename] = StatSignature(filename)
+            except OSError:
+                pass
+# Note the tree node each estimated file was averaged at
+    users = {}
+    for (key, info) in meta.iteritems():
+        if 'DELTA' in info:
+            path = KeyPath(key)[:-1]
+            users.setdefault(tuple(path[:Deepest(path, tree)[0]]), set()).add(key)
+    while True:
+        dirpaths = watcher.Wait()
+        stats.Reset()
+        stats.Start('rescan')
+        if dirpaths is None:
+            scanned.clear()
+            ScanTree(tops, True, bool(metadate), scanned=scanned)
+        else:
+            Rescan(scanned, dirpaths, bool(metadate))
+    # Find the files that have come, gone or changed
+        current = {}
+        for path in paths:
+            if not os.path.isdir(path):
+                try:
+                    current[path] = StatSignature(path)
+                except OSError:
+                    pass
+        for selected in WalkOrder(tops, scanned, metadate):
+            current.update(selected)
+        changed = [filename for filename in current
+                   if signatures.get(filename, False) != current[filename]]
+        changed.extend([filename for filename in signatures
+                        if filename not in current])
+        if not changed:
+            stats.Stop()
+            continue
+    # Parse their metadata
+        stats.Start('reparse')
+        for filename in changed:
+            signatures.pop(filename, None)
+        todo = [filename for filename in changed if filename in current]
+        signatures.update([(filename, current[filename]) for filename in todo])
+        parsed = []
+        for (filename, info) in ParseFiles(todo, signatures, cache, debug=debug):
+            if override and target not in info:
+                info = {}
+            parsed.append((filename, info))
+        if cache is not None:
+            cache.Save()
+    # Update their metadata & deltas, out of the way of any queries
+        lock.acquire()
+        try:
+            if index is not None and [filename for filename in changed
+                                      if (filename in meta) != (filename in current)]:
+                index.Changed()
+            for filename in changed:
+                if filename in meta:
+                    RemoveDelta(tree, filename)
+                    del meta[filename]
+            for (filename, info) in parsed:
+                meta[filename] = info
+                delta = LeafDelta(info, source, target)
+                if delta is not None:
+                    AddDelta(tree, filename, delta)
+        # Re-estimate the files averaged at any node along the changed paths
+            stats.Start('reestimate')
+            moved = set([()])
+            for filename in changed:
+                path = KeyPath(filename)[:-1]
+                moved.update([tuple(path[:depth]) for depth in range(1, len(path)+1)])
+            affected = set(todo)
+            for node in moved:
+                affected.update(users.pop(node, ()))
+            for key in affected:
+                if key not in meta:
+                    continue
+                info = meta[key]
+                previous = (info.get('TARGET', False), info.get('DELTA', None))
+                EstimateInfo(key, info, source, target, tree, override)
+                if 'DELTA' in info:
+                    path = KeyPath(key)[:-1]
+                    users.setdefault(tuple(path[:Deepest(path, tree)[0]]), set()).add(key)
+                if output and (info['TARGET'] != previous[0] or (
+                        debug and info.get('DELTA', None) != previous[1])):
+                    writer.Write(key, [info])
+        finally:
+            lock.release()
+        writer.Flush()
+        sys.stdout.flush()
+        stats.Finish()
+        if report is not None:
+            report()
 
 
 # Main program
 def main():
-# Init globals
-    global opts
-    SOURCE = 'broadcast'
-
 # Process arguments
-    parser = OptionParser(usage=u"%prog -dhouv [-M <metadate-limit>] [-t <target>] <metadata-filenames>]")
+    parser = OptionParser(usage=u"%prog -dhouv [-c <cachefile>] [-M <metadate-limit>] [-t <target>] <metadata-filenames>]")
+    parser.add_option( "-B", "--between", metavar="FROM TO", nargs=2, default=None,
+                       dest="between",
+                       help=u"Output only files with a --tag date in the range, from the index")
+    parser.add_option( "-b", "--basename", action="store_true", default=False,
+                       dest="basename",
+                       help=u"Output file names without directories or leading dot")
+    parser.add_option( "-c", "--cache", metavar="CACHEFILE", default=None,
+                       dest="cache",
+                       help=u"File to cache parsed metadata in between runs")
     parser.add_option( "-d", "--debug", action="store_true", default=False,
                        dest="debug",
                        help=u"Show debugging info")
+    parser.add_option( "-e", "--engine", metavar="ENGINE", default=None,
+                       dest="engine", choices=['numpy', 'python'],
+                       help=u"Estimating engine: numpy or python")
+    parser.add_option( "-f", "--format", metavar="FORMAT", default='text',
+                       dest="format", choices=list(Writer.FORMATS),
+                       help=u"Output format: text, jsonl, csv or tsv")
+    parser.add_option( "-g", "--tag", metavar="TAG", default=None,
+                       dest="tag",
+                       help=u"Tag of the dates for --between (default: the target)")
+    parser.add_option( "-H", "--has-tag", metavar="TAG", default=None,
+                       dest="has_tag",
+                       help=u"Output only files with a date for the tag (not a trailing field, eg: network), from the index")
+    parser.add_option( "-I", "--index", metavar="INDEXFILE", default=None,
+                       dest="index",
+                       help=u"File to keep the index of files by tag & date in")
+    parser.add_option( "-i", "--interval", metavar="SECONDS", type="float", default=5,
+                       dest="interval",
+                       help=u"Time between checks for changes when watching")
+    parser.add_option( "-j", "--jobs", metavar="JOBS", type="int", default=1,
+                       dest="jobs",
+                       help=u"Number of processes for scanning & parsing")
     parser.add_option( "-M", "--metadate", metavar="METADATE", default=False,
                        dest="metadate",
-                       help=u"Maximum modify date for metadata files")
+                       help=u"Maximum modify date(s) for metadata files")
+    parser.add_option( "-m", "--map", metavar="SHARDFILE", default=None,
+                       dest="map",
+                       help=u"Only write the partial sums of the paths (a shard) to the file")
+    parser.add_option( "-n", "--nearest", action="store_true", default=False,
+                       dest="nearest",
+                       help=u"Estimate from the nearest episodes in the same directory")
+    parser.add_option( "-O", "--sort", metavar="ORDER", default=None,
+                       dest="sort", choices=list(Writer.ORDERS),
+                       help=u"Output sorted by date or path")
     parser.add_option( "-o", "--override", action="store_true", default=False,
                        dest="override",
                        help=u"Override approximate dates with an estimate")
+    parser.add_option( "-P", "--pack", metavar="PACKFILE", default=None,
+                       dest="pack",
+                       help=u"Pack file to read the metadata hierarchies from")
+    parser.add_option( "-Q", "--serve", metavar="SOCKET", default=None,
+                       dest="serve",
+                       help=u"Answer queries on a Unix socket & keep up to date")
+    parser.add_option( "-R", "--repack", action="store_true", default=False,
+                       dest="repack",
+                       help=u"Rebuild the pack file from changed metadata first")
+    parser.add_option( "-r", "--reduce", action="store_true", default=False,
+                       dest="reduce",
+                       help=u"Merge the shard files given & output all their dates")
+    parser.add_option( "-S", "--stream", action="store_true", default=False,
+                       dest="stream",
+                       help=u"Output in path order as soon as each date is known")
     parser.add_option( "-s", "--source", metavar="SOURCE", default='broadcast',
                        dest="source",
-                       help=u"Source locality code for estimating")
+                       help=u"Source locality code(s) for estimating")
+    parser.add_option( "-T", "--stats", action="store_true", default=False,
+                       dest="stats",
+                       help=u"Report phase timings & counters on stderr")
+    parser.add_option( "--stats-json", action="store_true", default=False,
+                       dest="stats_json",
+                       help=u"Report phase timings & counters as JSON on stderr")
     parser.add_option( "-t", "--target", metavar="TARGET", default='AU',
                        dest="target",
-                       help=u"Target locality code for estimating")
+                       help=u"Target locality code(s) for estimating")
     parser.add_option( "-u", "--usage", action="store_true", default=False,
                        dest="usage",
                        help=u"Display examples for executing the shown script")
     parser.add_option( "-v", "--version", action="store_true", default=False,
                        dest="version",
                        help=u"Display version and author")
+    parser.add_option( "-w", "--watch", action="store_true", default=False,
+                       dest="watch",
+                       help=u"Keep watching for changes & output changed dates")
     (opts, args) = parser.parse_args()
 
 # Output debugging info?
@@ -311,66 +2510,125 @@ def main():
         parser.error("Must supply at least one metadata file name!")
         sys.exit(1)
 
-# Convert metadate to a date?
-    if opts.metadate:
-        opts.metadate = ParseDate(opts.metadate)
-        if opts.metadate:
-            opts.metadate = datetime.combine(opts.metadate, datetime.min.time())
-
-# Create file list
-    meta = {}
-    for path in args:
-        if not os.path.isdir(path):
-            meta[path] = {}
-        else:
-            for dirpath, dirs, files in os.walk(path):
-                oldname = False
-                startname = False
-                for name in sorted(files):
-                    fullname = os.path.join(dirpath, name)
-                    mtime = os.path.getmtime(fullname)
-                    mdate = datetime.fromtimestamp(mtime)
-                    if name.endswith('.meta'):
-                    # Normal case - check against metadate
-                        if oldname:
-                        # Finish off abnormal case handling
-                            meta[oldname] = {}
-                            oldname = False
-                        if opts.metadate and mdate > opts.metadate:
-                        # Problem with normal - look for older version
-                            startname = name
-                        else:
-                        # Normal case is okay
-                            startname = False
-                            meta[fullname] = {}
-                    elif startname and name.startswith(startname):
-                    # Abnormal - stop when metadate checks out (or fall thru)
-                        if mdate <= opts.metadate:
-                            oldname = fullname
-            # Finish outstanding abnormal case
-                if oldname:
-                    meta[oldname] = {}
-
-# Extract file info
-    for filename in meta:
-        if opts.debug == True:
-            sys.stderr.write(filename+'\n')
-        info = ParseMeta(filename)
-        if opts.override and opts.target not in info:
-            pass
+# Set up the engine
+    try:
+        engine = Engine(opts.source.split(','), opts.target.split(','),
+                        opts.override, opts.metadate and opts.metadate.split(','),
+                        opts.engine, opts.cache, opts.jobs, opts.debug,
+                        opts.pack, opts.nearest)
+        if opts.stream or opts.watch or opts.serve:
+            engine.CheckSingle()
+        if opts.map:
+            engine.CheckOne('mapping')
+        if opts.between or opts.has_tag:
+            engine.CheckOne('querying')
+    except ValueError, error:
+        parser.error(str(error))
+    if (opts.between or opts.has_tag) and not opts.index:
+        parser.error("Must supply an index file to query!")
+    if opts.nearest and (opts.map or opts.reduce):
+        parser.error("Cannot estimate from the nearest episodes when sharding!")
+    if opts.repack and not opts.pack:
+        parser.error("Must supply a pack file to repack!")
+    if opts.stream and (opts.watch or opts.serve):
+        parser.error("Cannot both stream and watch or serve!")
+    if opts.stream and opts.sort:
+        parser.error("Cannot sort when streaming!")
+    if opts.stream and opts.index:
+        parser.error("Cannot keep an index when streaming!")
+    if (opts.map or opts.reduce or opts.between or opts.has_tag) and (
+            opts.stream or opts.watch or opts.serve):
+        parser.error("Cannot stream, watch or serve when sharding or querying!")
+    if opts.reduce and opts.map:
+        parser.error("Cannot map when reducing!")
+    between = None
+    if opts.between:
+        between = [ParseDate(value) for value in opts.between]
+        if [value for value in between if not value or value.isEstimate]:
+            parser.error("The --between dates must be YYYY-MM-DD!")
+    writer = Writer(engine.pairs, opts.format, opts.sort, opts.basename,
+                    opts.debug, len(engine.metadates) > 1)
+    if opts.format != 'text':
+        WarnTo(sys.stderr)
+    report = None
+    if opts.stats or opts.stats_json:
+        report = lambda: stats.Report(opts.stats_json)
+
+    try:
+    # Stream the output?
+        if opts.stream:
+            stats.Start('stream')
+            engine.Stream(args, writer)
+
+    # Merge the partial sums of shards & output every shard's dates?
+        elif opts.reduce:
+            stats.Start('load')
+            partials = ReadPartials(args)
+            stats.Start('reduce')
+            for (filename, info) in ReducePartials(partials):
+                writer.Write(filename, [info])
+
+    # Query the date index?
+        elif opts.between or opts.has_tag:
+            stats.Start('index')
+            index = engine.Indexed(opts.index, args)
+            stats.Start('query')
+            for (filename, value) in index.Select(args, opts.tag or engine.pairs[0][1],
+                                                  between, opts.has_tag):
+                writer.Write(filename, [{'TARGET': value}])
+
         else:
-            meta[filename] = info
+        # Rebuild the pack file?
+            if opts.repack:
+                stats.Start('pack')
+                engine.Repack(args)
 
-# Estimate missing info
-    meta = Estimate(opts.source, opts.target, meta)
+        # Create file list for each metadate & extract file info
+            stats.Start('scan')
+            engine.Scan(args, opts.watch or opts.serve)
+            stats.Start('parse')
+            engine.Parse()
+            engine.Close()
 
-# Output info
-    for filename in meta:
-        if opts.debug != True:
-            print "%s:%s" % (filename, meta[filename]['TARGET'])
-        else: 
-            print "%s:%s" % (filename, meta[filename]['TARGET']),
-            print meta[filename].get('DELTA', None)
+        # Write the shard's partial sums, or estimate & output each metadate
+            if opts.map:
+                stats.Start('map')
+                engine.Map(opts.map)
+            elif not opts.serve or opts.watch:
+                for (run, metadate) in enumerate(engine.metadates):
+                    stats.Start('estimate')
+                    engine.Estimate(run)
+                    stats.Start('output')
+                    label = None
+                    if len(engine.metadates) > 1:
+                        label = metadate and metadate.date().isoformat()
+                    for (filename, infos) in engine.Results(run):
+                        writer.Write(filename, infos, label)
+                    writer.Flush()
+
+        # Keep the date index?
+            if opts.index and not opts.map:
+                stats.Start('index')
+                engine.Index(opts.index)
+    except ValueError, error:
+        parser.error(str(error))
+    writer.Flush()
+
+# Report statistics
+    sys.stdout.flush()
+    stats.Finish()
+    if report is not None:
+        report()
+
+# Keep watching for changes, answering any queries?
+    if opts.watch or opts.serve:
+        try:
+            engine.Watch(args, opts.interval, opts.serve, opts.watch, writer,
+                         report)
+        except KeyboardInterrupt:
+            pass
+        except ValueError, error:
+            parser.error(str(error))
 
 # Finished
     sys.exit(0)
@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+# $Id$
+# NAME
+#	tvdbstub - local stand-in for the TVDB web site
+# SYNTAX
+#	tvdbstub [-dhuv] [-D <delay>] [-e <episodes>] [-n <names>] [-P <parts>] [-p <port>] [-s <seasons>] [-U <names>]
+# DESCRIPTION
+#	Serves made up series & episode data the way TheTVDB.com XML API
+#	does, for testing the meta script without the real site, eg:
+#	meta -U http://localhost:8080 -b queries.txt
+#	Handles series searches (GetSeries.php), series information and
+#	all episodes information (as XML, or zipped for tvdb_api's useZip).
+#	Every series name searched for is found, unless names are given.
+# OPTIONS
+#	-D SECONDS, --delay=SECONDS
+#				time to wait before each response, to mimic
+#				a remote site (default: 0).
+#	-d, --debug		Show debugging info, logging each request.
+#	-e EPISODES, --episodes=EPISODES
+#				number of episodes per season (default: 13).
+#	-h, --help		Display help message.
+#	-n NAME[,...], --names=NAME[,...]
+#				only these series are found (default: any).
+#	-P PARTS, --parts=PARTS	number of episodes (parts) per story, named
+#				like "Story 2 (3)" (default: 0, for episodes
+#				named like "Episode 5").
+#	-p PORT, --port=PORT	port to serve on (default: 8080).
+#	-s SEASONS, --seasons=SEASONS
+#				number of seasons per series (default: 3).
+#	-U NAME[,...], --updated=NAME[,...]
+#				series updated since the others, for testing
+#				refreshes (default: none).
+#	-u, --usage		Display examples for executing the tvdbstub script.
+#	-v, --version		Display version and author.
+# AUTHOR
+#	Peter Lyons
+# IMPLEMENTATION
+#	A threading BaseHTTPServer, so concurrent requests overlap.
+# GLOBALS
+#	usage_description	initial usage text - basic summary
+#	usage_examples		ending usage text - contains command examples
+#	opts		parsed options information
+#
+
+
+"""Local stand-in for the TVDB web site."""
+__title__ = "TVDB.com Stand-in Server"
+__author__ = "darklion"
+__version__ = "0.1.2"
+# Version 0.1	Initial development: series search, series & episodes XML
+# Version 0.1.1	Optionally have some series updated since the others
+# Version 0.1.2	Optionally name episodes as parts of stories
+
+usage_description = '''
+This script serves made up TV series information the way TheTVDB.com does.
+
+'''
+usage_examples = '''
+Command examples:
+> tvdbstub -p 8080 &
+> meta -U http://localhost:8080 "Doctor Who" 23 1
+> tvdbstub -D 0.2 -n "Doctor Who,Blakes 7" &
+> printf 'Doctor Who 1 1\\nBlakes 7 2 3\\nNo Such Show\\n' | meta -U http://localhost:8080 -b -
+> tvdbstub -n "Doctor Who,Blakes 7" -U "Blakes 7" &
+> meta -U http://localhost:8080 -t 0 -R
+'''
+
+# System modules
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import sys
+import time
+import urlparse
+import zipfile
+import zlib
+from datetime import date, timedelta
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+# First broadcast date of every series, and when last updated
+FIRSTAIRED = date(1963, 11, 23)
+LASTUPDATED = 1434679247
+
+
+def SeriesId(seriesname):
+    '''Return the (stable) series id for a series name.'''
+    return 70000 + (zlib.crc32(seriesname.lower()) & 0xfffff)
+
+
+def Element(tag, value):
+    '''Return the XML element for the tag & value.'''
+    return "<%s>%s</%s>" % (tag, escape(str(value)), tag)
+
+
+def Lastupdated(seriesname):
+    '''Return the lastupdated value of a series.'''
+    if seriesname.lower() in opts.updated:
+        return opts.started
+    return LASTUPDATED
+
+
+def SeriesXml(sid, seriesname):
+    '''Return the XML Series record of a series.'''
+    return "<Series>%s</Series>" % "".join([
+        Element('id', sid), Element('seriesid', sid), Element('language', 'en'),
+        Element('SeriesName', seriesname), Element('FirstAired', FIRSTAIRED),
+        Element('Network', 'BBC One'), Element('Status', 'Ended'),
+        Element('Overview', 'Made up series for testing.'),
+        Element('lastupdated', Lastupdated(seriesname))])
+
+
+def EpisodeName(episode):
+    '''Return the name of an episode, as the part of a story if need be.'''
+    if opts.parts > 0:
+        return "Story %d (%d)" % ((episode - 1) // opts.parts + 1,
+                                  (episode - 1) % opts.parts + 1)
+    return "Episode %d" % episode
+
+
+def EpisodeXml(sid, season, episode):
+    '''Return the XML Episode record of an episode.'''
+    aired = FIRSTAIRED + timedelta(365 * (season - 1) + 7 * (episode - 1))
+    return "<Episode>%s</Episode>" % "".join([
+        Element('id', sid * 1000 + season * 100 + episode),
+        Element('seriesid', sid), Element('seasonid', sid * 100 + season),
+        Element('SeasonNumber', season), Element('EpisodeNumber', episode),
+        Element('EpisodeName', EpisodeName(episode)),
+        Element('FirstAired', aired), Element('lastupdated', 1341749911)])
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answers TVDB API requests from made up data.'''
+    def do_GET(self):
+        '''Answer a search, series or all episodes request.'''
+        time.sleep(opts.delay)
+        url = urlparse.urlparse(self.path)
+        path = url.path.split('/')
+        if url.path.endswith('/GetSeries.php'):
+            seriesname = urlparse.parse_qs(url.query).get('seriesname', [''])[0]
+            series = ""
+            if opts.names:
+                seriesname = opts.names.get(seriesname.lower(), '')
+            if seriesname:
+                sid = SeriesId(seriesname)
+                self.server.names[sid] = seriesname
+                series = SeriesXml(sid, seriesname)
+            self.Reply("<Data>%s</Data>" % series)
+        elif len(path) > 4 and path[-3] == 'series' and path[-2].isdigit():
+            sid = int(path[-2])
+            self.Reply("<Data>%s</Data>" % self.Series(sid))
+        elif len(path) > 5 and path[-2] == 'all' and path[-3].isdigit():
+            sid = int(path[-3])
+            data = "<Data>%s%s</Data>" % (self.Series(sid), "".join(
+                [EpisodeXml(sid, season, episode)
+                 for season in range(1, opts.seasons+1)
+                 for episode in range(1, opts.episodes+1)]))
+            if path[-1].endswith('.zip'):
+                self.Zip(path[-1][:-4] + '.xml', data)
+            else:
+                self.Reply(data)
+        else:
+            self.send_error(404)
+
+    def Series(self, sid):
+        '''Return the XML Series record for a series id.'''
+        return SeriesXml(sid, self.server.names.get(sid, "Series %d" % sid))
+
+    def Reply(self, data, contenttype='text/xml'):
+        '''Send the response data.'''
+        if contenttype == 'text/xml':
+            data = '<?xml version="1.0" encoding="UTF-8" ?>\n' + data
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def Zip(self, name, data):
+        '''Send the response data zipped up as the named file.'''
+        buffer = StringIO.StringIO()
+        archive = zipfile.ZipFile(buffer, 'w')
+        archive.writestr(name, '<?xml version="1.0" encoding="UTF-8" ?>\n' + data)
+        archive.close()
+        self.Reply(buffer.getvalue(), 'application/zip')
+
+    def log_message(self, format, *args):
+        '''Log requests only when debugging.'''
+        if opts.debug:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' Serves each request in its own thread, remembering the series
+        names searched for by their ids.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubHandler)
+        self.names = {}
+
+
+def main():
+# Init globals
+    global opts
+
+# Process arguments
+    parser = OptionParser(usage=u"%prog -dhuv [-D <delay>] [-e <episodes>] [-n <names>] [-p <port>] [-s <seasons>]")
+    parser.add_option( "-D", "--delay", metavar="SECONDS", type="float", default=0,
+                       dest="delay",
+                       help=u"Time to wait before each response")
+    parser.add_option( "-d", "--debug", action="store_true", default=False,
+                       dest="debug",
+                       help=u"Show debugging info")
+    parser.add_option( "-e", "--episodes", metavar="EPISODES", type="int", default=13,
+                       dest="episodes",
+                       help=u"Number of episodes per season")
+    parser.add_option( "-n", "--names", metavar="NAMES", default=None,
+                       dest="names",
+                       help=u"Names of the only series found")
+    parser.add_option( "-P", "--parts", metavar="PARTS", type="int", default=0,
+                       dest="parts",
+                       help=u"Number of episodes (parts) per story")
+    parser.add_option( "-p", "--port", metavar="PORT", type="int", default=8080,
+                       dest="port",
+                       help=u"Port to serve on")
+    parser.add_option( "-s", "--seasons", metavar="SEASONS", type="int", default=3,
+                       dest="seasons",
+                       help=u"Number of seasons per series")
+    parser.add_option( "-U", "--updated", metavar="NAMES", default='',
+                       dest="updated",
+                       help=u"Names of the series updated since the others")
+    parser.add_option( "-u", "--usage", action="store_true", default=False,
+                       dest="usage",
+                       help=u"Display examples for executing the tvdbstub script")
+    parser.add_option( "-v", "--version", action="store_true", default=False,
+                       dest="version",
+                       help=u"Display version and author")
+    (opts, args) = parser.parse_args()
+
+# Output debugging info?
+    if opts.debug == True:
+        print "opts", opts
+        print "\nargs", args
+
+# Output version info & terminate?
+    if opts.version == True:
+        sys.stdout.write("%s - %s (%s) by %s\n" %
+                         (__file__, __title__, __version__, __author__ ))
+        sys.exit(0)
+
+# Output usage info & terminate?
+    if opts.usage == True:
+        sys.stdout.write(usage_description)
+        parser.print_usage()
+        sys.stdout.write(usage_examples)
+        sys.exit(0)
+
+# Only some series?
+    if opts.names:
+        opts.names = dict([(name.strip().lower(), name.strip())
+                           for name in opts.names.split(',')])
+
+    opts.updated = set([name.strip().lower() for name in opts.updated.split(',')
+                        if name.strip()])
+    opts.started = int(time.time())
+
+# Serve until interrupted
+    server = StubServer(('localhost', opts.port))
+    if opts.names:
+        for name in opts.names.values():
+            server.names[SeriesId(name)] = name
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# Finished
+    sys.exit(0)
+#end main
+
+if __name__ == "__main__":
+    main()